@@ -0,0 +1,114 @@
+# coding: utf-8
+
+import random
+import string
+import time
+
+import click
+
+
+def _per_item(func, count):
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) / count * 1e9
+
+
+def _property_document(rng, size):
+    """Something shaped like a real `properties` column: settings, nested records, tags and text."""
+    def word():
+        return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10)))
+
+    return {
+        'settings': {word(): rng.choice([True, False, rng.randint(0, 100), word()]) for _ in range(10)},
+        'history': [{
+            'at': '2017-0{}-1{}T12:{:02d}:00'.format(rng.randint(1, 9), rng.randint(0, 9), rng.randint(0, 59)),
+            'event': rng.choice(['login', 'upload', 'comment', 'share']),
+            'score': rng.random() * 100,
+            'tags': [word() for _ in range(rng.randint(0, 4))],
+        } for _ in range(size)],
+        'bio': ' '.join(word() for _ in range(size * 4)),
+    }
+
+
+def register_commands(app):
+
+    @app.cli.command('bench-opaque-ids')
+    @click.option('--count', default=100000, help='Number of IDs to encode per run.')
+    def bench_opaque_ids(count):
+        """Compare the per-ID cost of the OpaqueEncoder code paths."""
+        from app.utils.security import encoder
+
+        ids = [random.randrange(1, 1 << 31) for _ in range(count)]
+
+        def computed(i):
+            # the round function evaluated on every call, as before the lookup table
+            t = encoder._transform
+            r = i & 0xffff
+            l = i >> 16 & 0xffff ^ t(r)  # noqa: E741
+            return "%08x" % (((r ^ t(l)) << 16) + l)
+
+        results = [
+            ('computed transform', _per_item(lambda: [computed(i) for i in ids], count)),
+            ('table encode_hex', _per_item(lambda: [encoder.encode_hex(i) for i in ids], count)),
+            ('encode_many', _per_item(lambda: encoder.encode_many(ids), count)),
+        ]
+
+        encoded = encoder.encode_many(ids)
+        results.append(('decode_many', _per_item(lambda: encoder.decode_many(encoded), count)))
+
+        for name, ns in results:
+            click.echo('{:<20} {:8.1f} ns/id'.format(name, ns))
+
+    @app.cli.command('bench-json-codec')
+    @click.option('--count', default=2000, help='Number of documents per run.')
+    @click.option('--size', default=20, help='Roughly how many nested records each document holds.')
+    def bench_json_codec(count, size):
+        """Compare serialize/parse cost and stored size of JSON column encodings."""
+        import json
+
+        from app.utils.sqlalchemy_json import codec
+
+        rng = random.Random(42)
+        documents = [_property_document(rng, rng.randint(1, size * 2)) for _ in range(count)]
+
+        compressed = codec.JsonCodec(codec.DEFAULT_COMPRESS_THRESHOLD)
+        encodings = [
+            ('json, default separators', json.dumps, json.loads),
+            ('codec, compact', codec.dumps, codec.loads),
+            ('codec, compressed', compressed.dumps, compressed.loads),
+        ]
+
+        click.echo('backend: {}'.format('rapidjson' if codec.rapidjson else codec.json.__name__))
+        for name, dumps, loads in encodings:
+            encoded = [dumps(x) for x in documents]
+            encode_us = _per_item(lambda: [dumps(x) for x in documents], count) / 1000
+            decode_us = _per_item(lambda: [loads(x) for x in encoded], count) / 1000
+            size_bytes = sum(len(x) for x in encoded) / count
+            click.echo('{:<26} {:8.1f} us/dumps {:8.1f} us/loads {:9.0f} bytes'.format(
+                name, encode_us, decode_us, size_bytes))
+
+    @app.cli.command('calibrate-passwords')
+    @click.option('--target-ms', default=100, help='Target time to hash one password, in milliseconds.')
+    def calibrate_passwords(target_ms):
+        """Suggest PASSWORD_PBKDF2_ROUNDS for the given hashing latency on this machine."""
+        from app.extensions.password import PasswordEngine
+
+        rounds = PasswordEngine.calibrate(target_ms)
+        click.echo('PASSWORD_PBKDF2_ROUNDS={}'.format(rounds))
+
+    @app.cli.command('rebuild-trigrams')
+    @click.option('--model', 'model_name', default=None, help='Only rebuild this model, e.g. User.')
+    @click.option('--batch-size', default=1000, help='Rows indexed per transaction.')
+    def rebuild_trigrams_command(model_name, batch_size):
+        """Rebuild the trigram index behind BaseQuery.contains()."""
+        from app.utils.database import db, rebuild_trigrams, Trigram
+
+        models = [x for x in db.Model._decl_class_registry.values() if isinstance(x, type) and issubclass(x, Trigram)]
+        if model_name is not None:
+            models = [x for x in models if x.__name__ == model_name]
+            if not models:
+                raise click.BadParameter('no trigram indexed model named {}'.format(model_name))
+
+        for model in models:
+            count = rebuild_trigrams(model, batch_size=batch_size)
+            click.echo('{}: {} rows'.format(model.__name__, count))
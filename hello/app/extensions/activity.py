@@ -0,0 +1,119 @@
+# coding: utf-8
+
+import atexit
+from datetime import datetime
+import logging
+import os
+import threading
+
+from sqlalchemy import case
+
+from app.models import User
+from app.utils.database import db
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityBuffer(object):
+    """Write-behind buffer for per-user activity timestamps.
+
+    `touch()` only records the latest timestamp per user and column in memory; a background thread
+    writes everything out as a single `UPDATE ... SET col = CASE id ...` every
+    `ACTIVITY_FLUSH_INTERVAL` milliseconds, or sooner once `ACTIVITY_FLUSH_MAX_USERS` users are
+    pending.  Whatever is left is flushed when the worker shuts down.
+    """
+
+    COLUMNS = ('last_login_at', 'last_request_at')
+
+    def __init__(self):
+        self.enabled = False
+        self.flush_interval = 5.0
+        self.max_users = 500
+        self._app = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        self._app = app
+        self.enabled = app.config['ACTIVITY_TRACKING']
+        self.flush_interval = app.config['ACTIVITY_FLUSH_INTERVAL'] / 1000.0
+        self.max_users = app.config['ACTIVITY_FLUSH_MAX_USERS']
+
+        atexit.register(self.flush)
+        if uwsgi is not None:
+            # uwsgi workers don't reliably run atexit handlers
+            uwsgi.atexit = self.flush
+
+    def touch(self, user_id, column='last_request_at', when=None):
+        if not self.enabled or user_id is None:
+            return
+
+        assert column in self.COLUMNS
+        when = when or datetime.utcnow()
+
+        with self._lock:
+            self._pending.setdefault(user_id, {})[column] = when
+            pending = len(self._pending)
+
+        self._ensure_thread()
+        if pending >= self.max_users:
+            self._wakeup.set()
+
+    def _ensure_thread(self):
+        # threads don't survive the uwsgi fork, so start one per worker process
+        pid = os.getpid()
+        if self._thread is None or self._pid != pid:
+            with self._lock:
+                if self._thread is None or self._pid != pid:
+                    self._pid = pid
+                    self._thread = threading.Thread(target=self._run, name='activity-flush', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('failed to flush user activity')
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return
+
+        table = User.__table__
+        values = {'modified_at': table.c.modified_at}  # activity is not a modification
+        for column in self.COLUMNS:
+            whens = {user_id: x[column] for user_id, x in pending.items() if column in x}
+            if whens:
+                values[column] = case(whens, value=table.c.id, else_=table.c[column])
+
+        statement = table.update().where(table.c.id.in_(list(pending))).values(**values)
+        try:
+            db.get_engine(self._app).execute(statement)
+        except Exception:
+            self._restore(pending)
+            raise
+
+    def _restore(self, pending):
+        """Put back entries that failed to flush, keeping whatever is newer for each user and column."""
+        with self._lock:
+            for user_id, columns in pending.items():
+                current = self._pending.setdefault(user_id, {})
+                for column, when in columns.items():
+                    current[column] = max(when, current.get(column, when))
+
+
+activity = ActivityBuffer()
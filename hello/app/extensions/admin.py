@@ -5,10 +5,11 @@ from flask_admin import Admin, AdminIndexView
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.contrib.sqla.form import AdminModelConverter
 from flask_admin.model.form import converts
+from sqlalchemy import desc, func
 from wtforms import fields
 
 from app.models import User
-from app.utils.database import db
+from app.utils.database import db, FullTextSearch, prefix_search_terms
 
 
 class AuthView(object):
@@ -31,15 +32,130 @@ class BaseModelConverter(AdminModelConverter):
         return fields.TextField(**field_args)
 
 
+class SeekPage(list):
+    """Rows of a list view page, with the URL of the page following them if any."""
+    next_url = None
+    approximate_count = False
+
+
 class MyModelView(AuthView, ModelView):
+    """Pages through the list in keyset order, see `BaseQuery.seek()`, with the row count taken from the
+    table statistics unless filtered.  Sorting on a related model's column falls back to OFFSET pages.
+    """
     model_form_converter = BaseModelConverter
+    list_template = 'admin/seek_list.html'
+    # counted in get_list()
+    simple_list_pager = True
+
+    def get_query(self):
+        # the session's own queries are plain Query objects, without seek() and approximate_count()
+        return self.model.query
+
+    def get_count_query(self):
+        return self.model.query.with_entities(func.count('*'))
+
+    def _seek_order(self, sort_column, sort_desc):
+        """The `BaseQuery.seek()` order for the list, or None if it can't be paged that way."""
+        if sort_column is None:
+            order = self._get_default_order()
+            if order is None:
+                return [desc(self.model.id)]
+            column, joins, sort_desc = order
+        elif sort_column in self._sortable_columns:
+            column, joins = self._sortable_columns[sort_column], self._sortable_joins.get(sort_column)
+        else:
+            return None
+
+        if joins or not hasattr(column, 'key') or getattr(self.model, column.key, None) is None:
+            return None
+        column = getattr(self.model, column.key)
+        return [desc(column) if sort_desc else column]
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        page_size = self.page_size if page_size is None else page_size
+        order_by = self._seek_order(sort_column, sort_desc)
+        if not execute or not page_size or order_by is None:
+            count, data = super().get_list(page, sort_column, sort_desc, search, filters, execute, page_size)
+            return count, data
+
+        # everything but the order and the limit
+        _, query = super().get_list(0, sort_column, sort_desc, search, filters, execute=False, page_size=0)
+        query = query.order_by(None)
+
+        rows, token = query.seek(after=request.args.get('after'), order_by=order_by, per_page=page_size)
+        data = SeekPage(rows)
+
+        if (self._search_supported and search) or (filters and self._filters):
+            count = query.count()
+        else:
+            count = query.approximate_count()
+            data.approximate_count = True
+
+        data.next_url = self._next_url(token)
+        return count, data
+
+    def _next_url(self, token):
+        if token is None:
+            return None
+
+        args = request.args.to_dict()
+        args.pop('page', None)
+        args['after'] = token
+        return self.get_url('.index_view', **args)
 
 
 class MyAdminIndexView(AuthView, AdminIndexView):
     pass
 
 
-class AdminUserView(MyModelView):
+class FullTextSearchMixin(object):
+    """Searches the model's FULLTEXT index instead of LIKE scans, best matches first unless sorted.
+
+    Ranked results are paged by relevance and id, see `BaseQuery.search_page()`.
+    """
+
+    def init_search(self):
+        self.column_searchable_list = self.model.__fulltext_columns__
+        return super().init_search()
+
+    def _search_clause(self, search):
+        return FullTextSearch(prefix_search_terms(search), self.model, boolean=True)
+
+    def _apply_search(self, query, count_query, joins, count_joins, search):
+        clause = self._search_clause(search)
+        query = query.filter(clause)
+        if count_query is not None:
+            count_query = count_query.filter(clause)
+        return query, count_query, joins, count_joins
+
+    def _apply_sorting(self, query, joins, sort_column, sort_desc):
+        search = request.args.get('search')
+        if sort_column is None and self._search_supported and search:
+            return query.order_by(desc(self._search_clause(search)), desc(self.model.id)), joins
+        return super()._apply_sorting(query, joins, sort_column, sort_desc)
+
+    def _seek_order(self, sort_column, sort_desc):
+        if sort_column is None and self._search_supported and request.args.get('search'):
+            # ranked by relevance, which get_list() pages on its own or else falls back to OFFSET
+            return None
+        return super()._seek_order(sort_column, sort_desc)
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        page_size = self.page_size if page_size is None else page_size
+        if sort_column is not None or not (self._search_supported and search) or not execute or not page_size:
+            return super().get_list(page, sort_column, sort_desc, search, filters, execute, page_size)
+
+        # filtered but neither searched nor sorted, search_page() does both
+        _, query = super().get_list(0, None, False, None, filters, execute=False, page_size=0)
+        query = query.order_by(None)
+
+        rows, token = query.search_page(search, self.model, after=request.args.get('after'), per_page=page_size)
+        data = SeekPage(row for row, score in rows)
+        data.next_url = self._next_url(token)
+        return query.filter(self._search_clause(search)).count(), data
+
+
+class AdminUserView(FullTextSearchMixin, MyModelView):
     column_list = [
         'id', 'first_name', 'last_name', 'email', 'is_staff', 'verified_at', 'created_at', 'modified_at', 'deleted_at'
     ]
@@ -0,0 +1,24 @@
+# coding: utf-8
+
+import os
+
+from werkzeug.utils import import_string
+
+
+class BlobStoreExtension(object):
+    """Configures the blob storage backend named by `BLOB_STORE_BACKEND` and delegates to it."""
+
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        backend_class = import_string(app.config['BLOB_STORE_BACKEND'])
+        self.backend = backend_class(app.config['BLOB_STORE_PATH'] or os.path.join(app.instance_path, 'blobs'))
+
+    def __getattr__(self, name):
+        if self.backend is None:
+            raise RuntimeError('blob store used before init_app')
+        return getattr(self.backend, name)
+
+
+blob_store = BlobStoreExtension()
@@ -0,0 +1,214 @@
+# coding: utf-8
+
+from collections import deque
+import logging
+import socket
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 3310
+
+
+class ClamAVError(Exception):
+    pass
+
+
+class ClamAVSizeLimitError(ClamAVError):
+    """The stream is longer than clamd's `StreamMaxLength`, scanning it again won't help."""
+
+
+class ClamdConnection(object):
+    """A clamd connection in IDSESSION mode, so it can run many INSTREAM scans in a row."""
+
+    def __init__(self, address, timeout):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.sock.sendall(b'zIDSESSION\0')
+        self.last_used = time.time()
+        self._buffer = b''
+
+    def begin(self):
+        self.sock.sendall(b'zINSTREAM\0')
+
+    def send(self, chunk):
+        if chunk:
+            self.sock.sendall(struct.pack('!L', len(chunk)) + chunk)
+
+    def end(self):
+        """Finish the stream and return clamd's verdict, e.g. `stream: OK`."""
+        self.sock.sendall(struct.pack('!L', 0))
+        self.last_used = time.time()
+
+        reply = self._read_reply()
+        # replies in a session are prefixed with the command id: "1: stream: OK"
+        return reply.split(': ', 1)[-1]
+
+    def close(self):
+        try:
+            self.sock.sendall(b'zEND\0')
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _read_reply(self):
+        while b'\0' not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ClamAVError('clamd closed the connection')
+            self._buffer += data
+
+        reply, self._buffer = self._buffer.split(b'\0', 1)
+        return reply.decode('utf-8', 'replace')
+
+
+class ClamdPool(object):
+    """Keeps up to `size` idle clamd sessions around for reuse."""
+
+    def __init__(self, address, size=4, timeout=10, idle_timeout=25):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                connection = self._idle.pop()
+                # clamd drops sessions that sit idle for longer than its IdleTimeout
+                if now - connection.last_used < self.idle_timeout:
+                    return connection
+                connection.close()
+
+        return ClamdConnection(self.address, self.timeout)
+
+    def release(self, connection, reuse=True):
+        with self._lock:
+            if reuse and len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+
+class ClamAVScanner(object):
+    """Streams chunks to clamd as they arrive.
+
+    `feed()` every chunk, then `finish()` returns the name of the detected signature or None.
+    `abort()` gives the connection up when the upload fails part way through.  Streams longer than
+    `max_length` are given up on before clamd cuts them off.
+    """
+
+    def __init__(self, pool, max_length=None):
+        self._pool = pool
+        self._connection = None
+        self._length = 0
+        self._max_length = max_length
+
+    def _start(self):
+        connection = self._pool.acquire()
+        try:
+            connection.begin()
+        except OSError:
+            # a pooled session went away, try once on a fresh one
+            connection.sock.close()
+            connection = ClamdConnection(self._pool.address, self._pool.timeout)
+            connection.begin()
+        self._connection = connection
+
+    def feed(self, chunk):
+        self._length += len(chunk)
+        if self._max_length and self._length > self._max_length:
+            self.abort()
+            raise ClamAVSizeLimitError('stream longer than {} bytes'.format(self._max_length))
+
+        try:
+            if self._connection is None:
+                self._start()
+            self._connection.send(chunk)
+        except OSError as e:
+            self.abort()
+            raise ClamAVError('unable to stream to clamd: {}'.format(e))
+
+    def finish(self):
+        try:
+            if self._connection is None:
+                self._start()
+            result = self._connection.end()
+        except OSError as e:
+            self.abort()
+            raise ClamAVError('unable to read clamd verdict: {}'.format(e))
+
+        self._pool.release(self._connection)
+        self._connection = None
+
+        if 'size limit exceeded' in result:
+            # "INSTREAM size limit exceeded. ERROR"
+            raise ClamAVSizeLimitError('clamd error: {}'.format(result))
+        if result.endswith('FOUND'):
+            # "stream: Eicar-Test-Signature FOUND"
+            return result[len('stream: '):-len(' FOUND')]
+        if result != 'stream: OK':
+            raise ClamAVError('clamd error: {}'.format(result))
+        return None
+
+    def abort(self):
+        if self._connection is not None:
+            self._pool.release(self._connection, reuse=False)
+            self._connection = None
+
+
+class ClamAV(object):
+    """Virus scanning against the clamd at `CLAMAV_SERVER` (`host[:port]` or a unix socket path)."""
+
+    def __init__(self):
+        self.pool = None
+        self.async_threshold = None
+        self.stream_max_length = None
+
+    def init_app(self, app):
+        server = app.config['CLAMAV_SERVER']
+        self.async_threshold = app.config['CLAMAV_ASYNC_THRESHOLD']
+        self.stream_max_length = app.config['CLAMAV_STREAM_MAX_LENGTH']
+        if not server:
+            self.pool = None
+            return
+
+        if server.startswith('/'):
+            address = server
+        else:
+            host, _, port = server.partition(':')
+            address = (host, int(port or DEFAULT_PORT))
+
+        self.pool = ClamdPool(
+            address,
+            size=app.config['CLAMAV_POOL_SIZE'],
+            timeout=app.config['CLAMAV_TIMEOUT'],
+            idle_timeout=app.config['CLAMAV_IDLE_TIMEOUT'])
+
+    @property
+    def enabled(self):
+        return self.pool is not None
+
+    def scanner(self):
+        return ClamAVScanner(self.pool, max_length=self.stream_max_length)
+
+    def scan(self, stream, chunk_size=64 * 1024):
+        """Scan a whole file object, returning the detected signature or None."""
+        scanner = self.scanner()
+        try:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                scanner.feed(chunk)
+        except Exception:
+            scanner.abort()
+            raise
+        return scanner.finish()
+
+
+clamav = ClamAV()
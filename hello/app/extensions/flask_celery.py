@@ -2,9 +2,9 @@
 
 import celery as _celery
 from celery.schedules import crontab
-from flask import g
+from flask import g, has_request_context
 
-from app.utils.database import db
+from app.utils.database import db, separate_session
 
 
 class Celery(_celery.Celery):
@@ -25,16 +25,26 @@ class Celery(_celery.Celery):
                 'schedule': crontab(hour=7, minute=30, day_of_week=1),
                 'args': (16, 16),
             },
+            'purge-stale-uploads-hourly': {
+                'task': 'app.tasks.purge_stale_uploads',
+                'schedule': crontab(minute=0),
+            },
         }
 
         if task_always_eager:
 
+            def run_eager(name, func, args, kwargs):
+                # on a session of its own like in a worker, the caller's may still be wrapping up a commit
+                with separate_session():
+                    result = func(*args, **kwargs)
+                    if db.session.new or db.session.deleted or db.session.dirty:
+                        raise Exception('State not committed before exiting task: {}'.format(name))
+                return result
+
             @app.after_request
             def handler(response):
                 for name, func, args, kwargs in getattr(g, 'after_request_tasks', []):
-                    func(*args, **kwargs)
-                    if db.session.new or db.session.deleted or db.session.dirty:
-                        raise Exception('State not committed before exiting task: {}'.format(name))
+                    run_eager(name, func, args, kwargs)
 
                 return response
 
@@ -42,6 +52,10 @@ class Celery(_celery.Celery):
                 abstract = True
 
                 def __call__(self, *args, **kwargs):
+                    if not has_request_context():
+                        # nothing to wait for outside of a request, e.g. in a manage.py command
+                        return run_eager(self.name, super().__call__, args, kwargs)
+
                     if not hasattr(g, 'after_request_tasks'):
                         g.after_request_tasks = []
                     g.after_request_tasks.append((self.name, super().__call__, args, kwargs))
@@ -0,0 +1,136 @@
+# coding: utf-8
+
+from contextlib import contextmanager
+import fcntl
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# written first, then moved into place
+TEMP_DIRECTORY = 'tmp'
+# temp files older than this were left behind by a worker that died mid-write
+STALE_TEMP_AGE = 60 * 60
+
+
+class DerivativeCache(object):
+    """Size-bounded LRU of rendered image derivatives on local disk.
+
+    Entries are files named by their key.  Hits bump the file's mtime.  The total size is kept in the
+    `size` file, which every worker process sharing the directory updates under the `lock` file, and
+    once it grows past `IMAGE_CACHE_MAX_SIZE` bytes the directory is rescanned and the least recently
+    used entries are removed until it is back under 90% of the limit.  Entries are written to `tmp/`
+    first; what a dead worker left there is removed on the next eviction.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.max_size = 0
+
+    def init_app(self, app):
+        self.root = os.path.abspath(app.config['IMAGE_CACHE_PATH'] or os.path.join(app.instance_path, 'image_cache'))
+        self.max_size = app.config['IMAGE_CACHE_MAX_SIZE']
+        os.makedirs(os.path.join(self.root, TEMP_DIRECTORY), exist_ok=True)
+
+        with self._locked():
+            self._remove_stale_temp_files()
+            self._write_size(sum(size for _, _, size in self._scan()))
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """Return the path of a cached derivative, or None."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(dir=os.path.join(self.root, TEMP_DIRECTORY), delete=False) as f:
+            f.write(data)
+
+        with self._locked():
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(f.name, path)
+
+            size = self._read_size() + len(data) - replaced
+            if self.max_size and size > self.max_size:
+                size = self._evict()
+            self._write_size(size)
+
+        return path
+
+    def evict(self):
+        with self._locked():
+            self._write_size(self._evict())
+
+    def _evict(self):
+        """Remove the least recently used entries down to 90% of the limit, returning the size left."""
+        self._remove_stale_temp_files()
+
+        entries = sorted(self._scan())
+        size = sum(x[2] for x in entries)
+        target = self.max_size * 0.9
+
+        for _, path, entry_size in entries:
+            if size <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+        return size
+
+    @contextmanager
+    def _locked(self):
+        # across worker processes as well as threads, each open file gets a lock of its own
+        with open(os.path.join(self.root, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _read_size(self):
+        try:
+            with open(os.path.join(self.root, 'size')) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return sum(size for _, _, size in self._scan())
+
+    def _write_size(self, size):
+        with open(os.path.join(self.root, 'size'), 'w') as f:
+            f.write(str(size))
+
+    def _remove_stale_temp_files(self):
+        deadline = time.time() - STALE_TEMP_AGE
+        for entry in os.scandir(os.path.join(self.root, TEMP_DIRECTORY)):
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+
+    def _scan(self):
+        for directory in os.scandir(self.root):
+            if not directory.is_dir() or directory.name == TEMP_DIRECTORY:
+                continue
+            for entry in os.scandir(directory.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, entry.path, stat.st_size
+
+
+image_cache = DerivativeCache()
@@ -1,18 +1,22 @@
 # coding: utf-8
 
-from datetime import datetime
+from collections import OrderedDict
 from functools import wraps
 import logging
 import re
+import threading
 import time
 
 from urllib.parse import urlparse
 
-from flask import current_app, g, redirect, request, url_for
+from flask import current_app, g, has_request_context, redirect, request, url_for
+from flask.ctx import _AppCtxGlobals
 from itsdangerous import BadSignature, TimedJSONWebSignatureSerializer
+from werkzeug.local import LocalProxy
 
-from app.models import User
+from app.extensions.activity import activity
 from app.utils.database import db
+from app.utils.identity import identity_cache, materialize
 from app.utils.routing import context_url
 
 logger = logging.getLogger(__name__)
@@ -20,6 +24,98 @@ logger = logging.getLogger(__name__)
 COOKIE_NAME_PATTERN = 'u{}'
 cookie_name_re = re.compile('u([0-9]+)')
 
+SESSION_ATTRIBUTES = frozenset(('current_user', 'current_user_fresh', 'real_user', 'known_users'))
+
+
+class SessionGlobals(_AppCtxGlobals):
+    """`g` that resolves the session attributes from the cookies on first access."""
+
+    def __getattr__(self, name):
+        if name in SESSION_ATTRIBUTES and has_request_context():
+            # keep anything already assigned, e.g. by logout_user(), over what the cookies say
+            assigned = {x: self.__dict__[x] for x in SESSION_ATTRIBUTES if x in self.__dict__}
+            _load_session()
+            self.__dict__.update(assigned)
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+
+class TokenCache(object):
+    """Bounded LRU of verified session tokens, keyed by namespace and raw cookie value.
+
+    Entries hold the decoded payload and the signed header so repeat requests can skip
+    the signature check entirely; expiry is still enforced on every lookup.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+token_cache = TokenCache()
+
+_serializers = {}
+
+
+def session_exempt(obj):
+    """Mark a view function or a whole blueprint as never needing the user session.
+
+    Requests to it skip cookie verification and user lookups, and never rewrite the cookie.
+    """
+    obj.session_exempt = True
+    return obj
+
+
+def _is_session_exempt():
+    endpoint = request.endpoint
+    if endpoint is None:
+        return False
+
+    if endpoint == 'static' or endpoint.endswith('.static'):
+        return True
+
+    if getattr(current_app.view_functions.get(endpoint), 'session_exempt', False):
+        return True
+
+    return getattr(current_app.blueprints.get(request.blueprint), 'session_exempt', False)
+
 
 def login_required(func):
 
@@ -53,35 +149,41 @@ def login_user(user, session_only=False):
     else:
         if current_app.config['SESSION_LIMIT_TO_ONE']:
             user.tick += 1
+            # every process checks the tick against the cookie, so it can't wait for the activity flush
+            db.session.commit()
 
         g.user_index = next_index()
 
         if session_only:
             fresh = False
 
-    user.last_login_at = datetime.utcnow()
-    db.session.commit()
+    activity.touch(user.id, 'last_login_at')
 
     g.current_user_fresh = fresh
     g.current_user = user
 
     g.real_user = g.current_user
+    g.session_dirty = True
 
 
 def logout_user():
     g.current_user = None
     g.real_user = None
+    g.session_dirty = True
 
 
 def refresh_user():
     g.current_user_fresh = True
+    g.session_dirty = True
 
     if current_app.config['SESSION_LIMIT_TO_ONE']:
-        g.current_user.tick += 1
+        # read the tick from the row, not from a possibly stale cached snapshot
+        materialize(g.current_user).tick += 1
 
 
 def switch_user(user):
     g.current_user_fresh = True
+    g.session_dirty = True
     g.current_user = user
 
 
@@ -89,30 +191,140 @@ def is_impersonating():
     return (g.real_user and g.real_user.is_staff and g.real_user != g.current_user)
 
 
+def _serializer(namespace=None, expires_in=None):
+    key = (current_app.config['SECRET_KEY'], namespace, expires_in)
+    s = _serializers.get(key)
+    if s is None:
+        s = _serializers[key] = TimedJSONWebSignatureSerializer(key[0], expires_in=expires_in, salt=namespace)
+    return s
+
+
 def _dumps(value, expires_in, namespace=None):
-    s = TimedJSONWebSignatureSerializer(current_app.config['SECRET_KEY'], expires_in=expires_in, salt=namespace)
+    s = _serializer(namespace, expires_in=expires_in)
 
     header_fields = {'t': time.time()}
 
     return s.dumps(value, header_fields=header_fields)
 
 
-def _loads(value, namespace=None, default=None):
-    s = TimedJSONWebSignatureSerializer(current_app.config['SECRET_KEY'], salt=namespace)
-    try:
-        payload, headers = s.loads(value, return_header=True)
-        now = time.time()
-        return now - headers['t'] < current_app.config['SESSION_MAX_AGE'], payload
-    except BadSignature as e:
-        logger.info(e)
-    return False, default
+def _loads(value, namespace=None, default=None, return_header=False):
+    key = (namespace, value)
+    entry = token_cache.get(key)
+    if entry is None:
+        s = _serializer(namespace)
+        try:
+            entry = s.loads(value, return_header=True)
+        except BadSignature as e:
+            logger.info(e)
+            return (False, default, None) if return_header else (False, default)
+        token_cache.set(key, entry)
+    elif entry[1]['exp'] < int(time.time()):
+        # same check itsdangerous does on a full verification
+        token_cache.discard(key)
+        logger.info('Signature expired')
+        return (False, default, None) if return_header else (False, default)
+
+    payload, headers = entry
+    now = time.time()
+    fresh = now - headers['t'] < current_app.config['SESSION_MAX_AGE']
+    if return_header:
+        return fresh, dict(payload), headers
+    return fresh, dict(payload)
+
+
+def _needs_refresh(value, max_age):
+    """Decide whether the session cookie for the current index has to be re-signed.
+
+    Without SESSION_REFRESH_ON_CHANGE the cookie is rewritten on every response.  Otherwise
+    it is only rewritten when the payload or lifetime changed, or once the token is older
+    than SESSION_REFRESH_FRACTION of its lifetime (or of SESSION_MAX_AGE while it is fresh,
+    so freshness keeps sliding for active users).
+    """
+    if not current_app.config['SESSION_REFRESH_ON_CHANGE'] or g.get('session_dirty'):
+        return True
+
+    token = g.get('session_tokens', {}).get(g.user_index)
+    if token is None:
+        return True
+
+    payload, headers = token
+    if payload != value or headers['exp'] - headers['iat'] != max_age:
+        return True
+
+    lifetime = max_age
+    if value.get('real_user_tick') is not None:
+        lifetime = min(lifetime, current_app.config['SESSION_MAX_AGE'])
+
+    return time.time() - headers['t'] >= lifetime * current_app.config['SESSION_REFRESH_FRACTION']
+
+
+def _load_session():
+    values = []
+    g.session_tokens = tokens = {}
+    for name in request.cookies.keys():
+        m = cookie_name_re.match(name)
+        if m:
+            idx = m.groups()[0]
+            fresh, d, headers = _loads(request.cookies[name], return_header=True)
+            if d:
+                tokens[int(idx)] = (dict(d), headers)
+                d['fresh'] = fresh
+                values.append((int(idx), d))
+
+    values.sort(key=lambda x: x[0])
+
+    user_ids = {x[1].get('user_id') for x in values} | {x[1].get('real_user_id') for x in values}
+    # a tick newer than the cached one means the user logged in again through another process
+    ticks = {}
+    for i, d in values:
+        if d.get('real_user_id') and d.get('real_user_tick') is not None:
+            ticks[d['real_user_id']] = max(ticks.get(d['real_user_id'], 0), d['real_user_tick'])
+    users = identity_cache.get_many([x for x in user_ids if x], ticks=ticks)
+
+    g.known_users = known_users = []
+    found_data = None
+    found_index = 0
+    for (i, d) in values:
+        real_user = users.get(d.get('real_user_id'))
+        fresh = d['fresh'] = d.get('fresh', False) and real_user and real_user.tick == d.get('real_user_tick')
+        known_users.append((i, users.get(d.get('user_id')),
+                            d.get('user_id') != d.get('real_user_id'), fresh))
+
+        if i == g.user_index:
+            found_data = d
+            found_index = len(known_users) - 1
+
+    d = {}
+    if found_data:
+        d = found_data
+        known_users.insert(0, known_users.pop(found_index))
+    elif g.user_index and len(values) > 0:
+        g.user_index = None
+        return redirect(context_url(request.url, user_index=values[0][0]))
+
+    g.current_user_fresh = d.get('fresh')
+    g.current_user = users.get(d.get('user_id'))
+    g.real_user = users.get(d.get('real_user_id'))
 
 
 def init_app(app):
+    app.app_ctx_globals_class = SessionGlobals
+
+    token_cache.max_size = app.config['SESSION_TOKEN_CACHE_SIZE']
+    token_cache.clear()
+
+    identity_cache.ttl = app.config['SESSION_IDENTITY_CACHE_TTL']
+    identity_cache.max_size = app.config['SESSION_IDENTITY_CACHE_SIZE']
+    identity_cache.clear()
 
     @app.after_request
     def after_request(response):
-        if g.user_index is not None:
+        # g.get() doesn't resolve a lazy session, requests that never looked at it aren't counted
+        real_user = g.get('real_user')
+        if real_user:
+            activity.touch(real_user.id)
+
+        if g.user_index is not None and not g.get('session_exempt'):
             d = {}
             max_age = 0
 
@@ -125,6 +337,9 @@ def init_app(app):
                 d['real_user_id'] = g.real_user.id if g.real_user and g.real_user else None
                 d['real_user_tick'] = (g.real_user.tick if g.real_user else None) if g.current_user_fresh else None
 
+            if not _needs_refresh(d, max_age):
+                return response
+
             parsed_url = urlparse(request.url)
 
             response.set_cookie(
@@ -138,52 +353,24 @@ def init_app(app):
 
     @app.before_request
     def before_request():
-        values = []
-        for name in request.cookies.keys():
-            m = cookie_name_re.match(name)
-            if m:
-                idx = m.groups()[0]
-                fresh, d = _loads(request.cookies[name])
-                if d:
-                    d['fresh'] = fresh
-                    values.append((int(idx), d))
-
-        values.sort(key=lambda x: x[0])
-
-        user_ids = {x[1].get('user_id') for x in values} | {x[1].get('real_user_id') for x in values}
-        users = {x.id: x for x in User.query.filter(User.id.in_([x for x in user_ids if x]))}
-
-        g.known_users = known_users = []
-        found_data = None
-        found_index = 0
-        for (i, d) in values:
-            real_user = users.get(d.get('real_user_id'))
-            fresh = d['fresh'] = d.get('fresh', False) and real_user and real_user.tick == d.get('real_user_tick')
-            known_users.append((i, users.get(d.get('user_id')),
-                                d.get('user_id') != d.get('real_user_id'), fresh))
-
-            if i == g.user_index:
-                found_data = d
-                found_index = len(known_users) - 1
-
-        d = {}
-        if found_data:
-            d = found_data
-            known_users.insert(0, known_users.pop(found_index))
-        elif g.user_index and len(values) > 0:
-            g.user_index = None
-            return redirect(context_url(request.url, user_index=values[0][0]))
-
-        g.current_user_fresh = d.get('fresh')
-        g.current_user = users.get(d.get('user_id'))
-        g.real_user = users.get(d.get('real_user_id'))
+        if _is_session_exempt():
+            g.session_exempt = True
+            g.current_user_fresh = None
+            g.current_user = None
+            g.real_user = None
+            g.known_users = []
+        elif g.user_index:
+            # an explicit index has to be validated up front since it may redirect,
+            # everything else is resolved the first time the session is touched
+            return _load_session()
 
     @app.context_processor
     def context_processor():
+        # proxies so that templates which never look at the session don't resolve it
         return dict(
             user_index=g.user_index,
-            current_user_fresh=g.current_user_fresh,
-            current_user=g.current_user,
-            impersonating=is_impersonating(),
-            real_user=g.real_user,
-            known_users=g.known_users)
+            current_user_fresh=LocalProxy(lambda: g.current_user_fresh),
+            current_user=LocalProxy(lambda: g.current_user),
+            impersonating=LocalProxy(is_impersonating),
+            real_user=LocalProxy(lambda: g.real_user),
+            known_users=LocalProxy(lambda: g.known_users))
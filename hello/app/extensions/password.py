@@ -0,0 +1,127 @@
+# coding: utf-8
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import os
+import threading
+import time
+
+import passlib.context
+from werkzeug.exceptions import ServiceUnavailable
+
+logger = logging.getLogger(__name__)
+
+pwd_context = passlib.context.CryptContext(schemes=["pbkdf2_sha256", "des_crypt"], deprecated=["des_crypt"])
+
+_contexts = {}
+
+
+def _context(rounds):
+    if not rounds:
+        return pwd_context
+
+    context = _contexts.get(rounds)
+    if context is None:
+        context = _contexts[rounds] = pwd_context.copy(pbkdf2_sha256__default_rounds=rounds)
+    return context
+
+
+# these run inside the pool's worker processes, so they must stay module level functions
+
+
+def _hash(plain_text_password, rounds):
+    return _context(rounds).hash(plain_text_password)
+
+
+def _verify_and_update(plain_text_password, password, rounds):
+    return _context(rounds).verify_and_update(plain_text_password, password)
+
+
+class PasswordEngineBusyException(ServiceUnavailable):
+    pass
+
+
+class PasswordEngine(object):
+    """Runs password hashing and verification in a small process pool.
+
+    Each web process allows at most `PASSWORD_ENGINE_MAX_PENDING` operations in flight, waiting up to
+    `PASSWORD_ENGINE_TIMEOUT` seconds for a slot and again for the result, so a burst of logins queues
+    in the pool instead of tying up every request thread on CPU.  With `PASSWORD_ENGINE_WORKERS` set to
+    0 everything runs inline, as before.
+    """
+
+    def __init__(self):
+        self.workers = 0
+        self.max_pending = 1
+        self.timeout = None
+        self.rounds = None
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.workers = app.config['PASSWORD_ENGINE_WORKERS']
+        self.max_pending = app.config['PASSWORD_ENGINE_MAX_PENDING']
+        self.timeout = app.config['PASSWORD_ENGINE_TIMEOUT']
+        self.rounds = app.config['PASSWORD_PBKDF2_ROUNDS']
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _get_executor(self):
+        # uwsgi forks workers after import, so every process needs its own pool
+        pid = os.getpid()
+        if self._executor is None or self._pid != pid:
+            with self._lock:
+                if self._executor is None or self._pid != pid:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    self._pid = pid
+        return self._executor
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordEngineBusyException('Too many sign in attempts in progress, please try again.')
+
+        try:
+            future = self._get_executor().submit(func, *args)
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise PasswordEngineBusyException('Timed out checking the password, please try again.')
+        except BrokenProcessPool:
+            logger.exception('password pool died, starting a new one')
+            self._executor = None
+            raise PasswordEngineBusyException('Unable to check the password, please try again.')
+        finally:
+            self._slots.release()
+
+    def hash(self, plain_text_password):
+        return self._run(_hash, plain_text_password, self.rounds)
+
+    def verify(self, plain_text_password, password):
+        return self.verify_and_update(plain_text_password, password)[0]
+
+    def verify_and_update(self, plain_text_password, password):
+        """Returns `(matched, new_hash)`, `new_hash` being set when the stored hash should be replaced."""
+        if not (password and plain_text_password):
+            return False, None
+        return self._run(_verify_and_update, plain_text_password, password, self.rounds)
+
+    @staticmethod
+    def calibrate(target_ms, samples=5, probe_rounds=10000):
+        """Pick the pbkdf2_sha256 rounds that take about `target_ms` to hash on this machine."""
+        timings = []
+        for _ in range(samples):
+            context = _context(probe_rounds)
+            start = time.perf_counter()
+            context.hash('calibration password')
+            timings.append(time.perf_counter() - start)
+
+        per_round = sorted(timings)[len(timings) // 2] / probe_rounds
+        return max(1000, int(target_ms / 1000.0 / per_round))
+
+
+password_engine = PasswordEngine()
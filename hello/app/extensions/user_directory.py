@@ -0,0 +1,348 @@
+# coding: utf-8
+
+from array import array
+from bisect import bisect_left, insort
+from datetime import timedelta
+import heapq
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import object_session
+from werkzeug.exceptions import ServiceUnavailable
+
+from app.models import User
+from app.utils.database import call_after_commit, db, fold_text
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
+logger = logging.getLogger(__name__)
+
+# how far back each refresh looks again, for rows committed a while after their modified_at was set
+REFRESH_OVERLAP = timedelta(minutes=1)
+BATCH_SIZE = 10000
+
+
+class UserDirectoryNotReadyException(ServiceUnavailable):
+    pass
+
+
+class PackedPrefixIndex(object):
+    """Read-only sorted array of `term \\0 id` keys, answering prefix lookups with a binary search.
+
+    The keys are packed into a single bytes buffer with their offsets in an array, a few bytes over
+    the terms themselves per key where a list of strings costs about a hundred, which is what lets
+    it hold millions of users.
+    """
+
+    def __init__(self, items=()):
+        """`items` are `(id, terms)` pairs."""
+        keys = sorted(x.encode('utf-8') + b'\0' + id.to_bytes(4, 'big') for id, terms in items for x in set(terms))
+        self._offsets = array('I', [0])
+        for key in keys:
+            self._offsets.append(self._offsets[-1] + len(key))
+        self._data = b''.join(keys)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _key(self, i):
+        return self._data[self._offsets[i]:self._offsets[i + 1]]
+
+    def scan(self, prefix):
+        """`(term, id)` for every term starting with `prefix`, in order, the term as UTF-8."""
+        prefix = prefix.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        for i in range(lo, len(self)):
+            key = self._key(i)
+            if not key.startswith(prefix):
+                break
+            yield key[:-5], int.from_bytes(key[-4:], 'big')
+
+
+class PackedRecords(object):
+    """Read-only `{id: (first_name, last_name, email)}` packed into a bytes buffer, like `PackedPrefixIndex`."""
+
+    SEPARATOR = '\x1f'
+    NULL = '\0'
+
+    def __init__(self, records=None):
+        records = records or {}
+        self._ids = array('I', sorted(records))
+        self._offsets = array('I', [0])
+        chunks = []
+        for id in self._ids:
+            chunk = self.SEPARATOR.join(self.NULL if x is None else x for x in records[id]).encode('utf-8')
+            chunks.append(chunk)
+            self._offsets.append(self._offsets[-1] + len(chunk))
+        self._data = b''.join(chunks)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, id):
+        i = bisect_left(self._ids, id)
+        if i == len(self._ids) or self._ids[i] != id:
+            return None
+        values = self._data[self._offsets[i]:self._offsets[i + 1]].decode('utf-8').split(self.SEPARATOR)
+        return tuple(None if x == self.NULL else x for x in values)
+
+
+class PrefixIndex(object):
+    """Sorted list of `term \\0 id` keys, answering prefix lookups with a binary search.
+
+    Changes are inserted in place, which moves the tail of the list, fast enough for the changes
+    made between two rebuilds of the packed index.
+    """
+
+    SEPARATOR = '\0'
+
+    def __init__(self):
+        self._keys = []
+        self._terms = {}
+
+    def __len__(self):
+        return len(self._terms)
+
+    def _key(self, term, id):
+        return '{}{}{:08x}'.format(term, self.SEPARATOR, id)
+
+    def add(self, id, terms):
+        self.remove(id)
+        self._terms[id] = terms = tuple(set(terms))
+        for term in terms:
+            insort(self._keys, self._key(term, id))
+
+    def remove(self, id):
+        for term in self._terms.pop(id, ()):
+            key = self._key(term, id)
+            i = bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+
+    def scan(self, prefix):
+        """`(term, id)` for every term starting with `prefix`, in order, the term as UTF-8."""
+        keys = self._keys
+        for i in range(bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            term, _, id = keys[i].rpartition(self.SEPARATOR)
+            yield term.encode('utf-8'), int(id, 16)
+
+
+def _terms(first_name, last_name, email):
+    terms = [first_name, last_name, email, ' '.join(x for x in (first_name, last_name) if x)]
+    return [fold_text(x) for x in terms if x]
+
+
+class UserDirectory(object):
+    """Per-process prefix index of the active users' names and emails, for autocomplete.
+
+    Each worker process builds its index in a background thread, right after uwsgi forks it or else
+    on its first lookup; lookups made before it is ready get a 503.  The index is packed at every
+    build, see `PackedPrefixIndex`.  Changes made in this process go into a small overlay as they
+    commit.  The thread picks up everyone else's every `USER_DIRECTORY_REFRESH_INTERVAL` seconds by
+    querying on `modified_at`, and rebuilds from scratch every `USER_DIRECTORY_REBUILD_INTERVAL`
+    seconds, which folds the overlay back in and is how rows deleted elsewhere drop out.  Lookups
+    never touch the database.
+    """
+
+    COLUMNS = ('id', 'first_name', 'last_name', 'email', 'is_active', 'modified_at')
+
+    def __init__(self):
+        self.enabled = False
+        self.refresh_interval = 30.0
+        self.rebuild_interval = 3600.0
+        self._app = None
+        self._index = PackedPrefixIndex()
+        self._records = PackedRecords()
+        # changed since the build: {id: record, or None once gone}, with the current terms in _overlay
+        self._changes = {}
+        self._overlay = PrefixIndex()
+        self._since = None
+        self._built_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        self._app = app
+        self.enabled = app.config['USER_DIRECTORY']
+        self.refresh_interval = app.config['USER_DIRECTORY_REFRESH_INTERVAL']
+        self.rebuild_interval = app.config['USER_DIRECTORY_REBUILD_INTERVAL']
+
+        if self.enabled and postfork is not None:
+            postfork(self.warm)
+
+    @property
+    def ready(self):
+        return self._built_at is not None and self._pid == os.getpid()
+
+    def warm(self):
+        """Start building the index in the background if this process doesn't have one yet."""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid != pid:
+                # an index copied over by a fork no longer gets this process's changes
+                self._built_at = None
+                self._pid = pid
+                self._thread = threading.Thread(target=self._run, name='user-directory-refresh', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Let the background thread exit after its current pass; the next lookup starts another."""
+        with self._lock:
+            self._built_at = None
+            self._pid = None
+            self._thread = None
+
+    def _run(self):
+        while self._thread is threading.current_thread():
+            try:
+                if self._built_at is None or time.time() - self._built_at > self.rebuild_interval:
+                    self.rebuild()
+                else:
+                    self.refresh()
+            except Exception:
+                logger.exception('failed to refresh the user directory')
+            time.sleep(self.refresh_interval)
+
+    def _select(self):
+        table = User.__table__
+        return select([table.c[x] for x in self.COLUMNS])
+
+    def rebuild(self):
+        table = User.__table__
+        engine = db.get_engine(self._app)
+        started_at = time.time()
+
+        records, since, last_id = {}, None, 0
+        while True:
+            batch = engine.execute(
+                self._select().where(table.c.id > last_id).order_by(table.c.id).limit(BATCH_SIZE)).fetchall()
+            for row in batch:
+                if row.is_active:
+                    records[row.id] = (row.first_name, row.last_name, row.email)
+                since = row.modified_at if since is None else max(since, row.modified_at)
+            if len(batch) < BATCH_SIZE:
+                break
+            last_id = batch[-1].id
+
+        index = PackedPrefixIndex((id, _terms(*x)) for id, x in records.items())
+        packed = PackedRecords(records)
+        del records
+
+        with self._lock:
+            self._index, self._records = index, packed
+            self._changes, self._overlay = {}, PrefixIndex()
+            self._since = since
+            self._built_at = started_at
+
+        logger.info('user directory built with %d users in %.2fs', len(packed), time.time() - started_at)
+
+    def refresh(self):
+        """Apply the users modified since the last build or refresh."""
+        if self._since is None:
+            return self.rebuild()
+
+        table = User.__table__
+        rows = db.get_engine(self._app).execute(
+            self._select().where(table.c.modified_at >= self._since - REFRESH_OVERLAP)).fetchall()
+
+        for row in rows:
+            if row.is_active:
+                self.put(row.id, row.first_name, row.last_name, row.email)
+            else:
+                self.discard(row.id)
+
+        with self._lock:
+            self._since = max([self._since] + [x.modified_at for x in rows])
+
+    def _get(self, id):
+        if id in self._changes:
+            return self._changes[id]
+        return self._records.get(id)
+
+    def put(self, id, first_name, last_name, email):
+        with self._lock:
+            if self._get(id) == (first_name, last_name, email):
+                return
+            self._changes[id] = (first_name, last_name, email)
+            self._overlay.add(id, _terms(first_name, last_name, email))
+
+    def discard(self, id):
+        with self._lock:
+            if self._get(id) is not None:
+                self._changes[id] = None
+                self._overlay.remove(id)
+
+    def search(self, text, limit=10):
+        """Users with a name or email starting with `text`, as dictionaries, in the order of the terms matched."""
+        prefix = fold_text(text.strip())
+        if not prefix:
+            return []
+
+        self.warm()
+        if not self.ready:
+            raise UserDirectoryNotReadyException('The user directory is loading, please try again shortly.')
+
+        with self._lock:
+            # packed entries changed since the build are superseded by the overlay
+            packed = ((term, id) for term, id in self._index.scan(prefix) if id not in self._changes)
+
+            ids = []
+            for _, id in heapq.merge(packed, self._overlay.scan(prefix)):
+                if id not in ids:
+                    ids.append(id)
+                    if len(ids) == limit:
+                        break
+            records = [(x, self._get(x)) for x in ids]
+
+        return [{'id': id, 'first_name': first_name, 'last_name': last_name, 'email': email}
+                for id, (first_name, last_name, email) in records]
+
+
+user_directory = UserDirectory()
+
+
+def _apply_after_commit(target, deleted=False):
+    if not user_directory.ready:
+        return
+
+    if deleted or not target.is_active:
+        call_after_commit(object_session(target), user_directory.discard, target.id)
+    else:
+        call_after_commit(
+            object_session(target), user_directory.put, target.id, target.first_name, target.last_name, target.email)
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    _apply_after_commit(target)
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[x].history.has_changes() for x in ('first_name', 'last_name', 'email', 'is_active')):
+        _apply_after_commit(target)
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    _apply_after_commit(target, deleted=True)
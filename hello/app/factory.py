@@ -6,12 +6,19 @@ import os
 from flask import Flask, g, redirect, render_template, request, url_for
 from werkzeug.debug import DebuggedApplication
 
+from app.commands import register_commands
+from app.extensions.activity import activity
 from app.extensions.admin import admin
 from app.extensions.assets import assets
+from app.extensions.blob_store import blob_store
+from app.extensions.clamav import clamav
 from app.extensions.flask_celery import celery
-from app.extensions.login import init_app as login_init_app, login_user
+from app.extensions.image_cache import image_cache
+from app.extensions.login import init_app as login_init_app, login_user, session_exempt
 from app.extensions.mail import mail
 from app.extensions.migrate import migrate
+from app.extensions.password import password_engine
+from app.extensions.user_directory import user_directory
 from app.models import User
 from app.utils.database import db
 from app.utils.jinja import register_jinja_filters
@@ -38,13 +45,19 @@ def create_app(import_name):
     ###
     # Register Extensions
     ##
+    activity.init_app(app)
     admin.init_app(app)
     assets.init_app(app)
+    blob_store.init_app(app)
     celery.init_app(app)
+    clamav.init_app(app)
     db.init_app(app)
+    image_cache.init_app(app)
     login_init_app(app)
     mail.init_app(app)
     migrate.init_app(app=app, db=db)
+    password_engine.init_app(app)
+    user_directory.init_app(app)
 
     if app.config['DEBUG']:
         app.config['ASSETS_DEBUG'] = True
@@ -65,9 +78,11 @@ def create_app(import_name):
     # Register View endpoints
     ##
 
-    from app.views import auth, home
+    from app.views import auth, home, uploads, users
     app.register_blueprint(auth.bp, url_prefix="/auth")
     app.register_blueprint(home.bp)
+    app.register_blueprint(uploads.bp, url_prefix="/uploads")
+    app.register_blueprint(users.bp, url_prefix="/users")
 
     @app.route('/u/')
     def handle_user_base_url():
@@ -97,6 +112,7 @@ def create_app(import_name):
             return 'MISMATCH', 200
 
     @app.route('/health/ping/')
+    @session_exempt
     def ping():
         return 'pong', 200
 
@@ -137,6 +153,11 @@ def create_app(import_name):
     ###
     register_jinja_filters(app.jinja_env)
 
+    ###
+    # Custom CLI Commands
+    ###
+    register_commands(app)
+
     ###
     # Inject Shell Context Variables
     ##
@@ -1,4 +1,5 @@
 # coding: utf-8
 # flake8: noqa
 
+from .file import *
 from .user import *
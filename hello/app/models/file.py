@@ -0,0 +1,40 @@
+# coding: utf-8
+
+import base64
+from io import BytesIO
+
+from app.extensions.blob_store import blob_store
+from app.utils.database import db
+
+__all__ = ['File']
+
+
+class File(db.Model, db.Timestamp, db.HasProperties):
+
+    name = db.Column(db.Unicode(255), nullable=False)
+    digest = db.Column(db.String(64), index=True)
+    size = db.Column(db.BigInteger)
+    mimetype = db.Column(db.Unicode(255))
+    quarantined = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __init__(self, stream=None, **kwargs):
+        super().__init__(**kwargs)
+
+        if stream is not None:
+            self.digest, self.size = blob_store.put(stream)
+
+    def __unicode__(self):
+        return self.name
+
+    def open(self):
+        """Return a readable binary file object with the contents."""
+        if self.digest:
+            return blob_store.open(self.digest)
+
+        # rows stored before the blob store kept their contents base64 encoded in properties
+        return BytesIO(base64.b64decode(self.properties['data']))
+
+    @property
+    def path(self):
+        """Local path of the contents, when the blob store has one."""
+        return blob_store.path(self.digest) if self.digest else None
@@ -2,20 +2,19 @@
 
 from datetime import datetime, timedelta
 
-import passlib.context
 import passlib.pwd
 from sqlalchemy.orm import synonym
 
+from app.extensions.password import password_engine
 from app.utils.database import db
 
 __all__ = ['User']
 
-pwd_context = passlib.context.CryptContext(schemes=["pbkdf2_sha256", "des_crypt"])
 
-
-class User(db.Model, db.Timestamp, db.HasProperties, db.FullText):
+class User(db.Model, db.Timestamp, db.HasProperties, db.FullText, db.Trigram):
 
     __fulltext_columns__ = ('first_name', 'last_name')
+    __trigram_columns__ = ('first_name', 'last_name', 'email')
 
     first_name = db.Column(db.Unicode(64))
     last_name = db.Column(db.Unicode(64))
@@ -38,7 +37,23 @@ class User(db.Model, db.Timestamp, db.HasProperties, db.FullText):
 
     @staticmethod
     def check_password(password, plain_text_password):
-        return password and plain_text_password and pwd_context.verify(plain_text_password, password)
+        return password_engine.verify(plain_text_password, password)
+
+    def verify_password(self, plain_text_password):
+        """Check against the password, then the temp password, rehashing legacy hashes on a match."""
+        password_match, new_hash = password_engine.verify_and_update(plain_text_password, self._password)
+        if password_match:
+            if new_hash:
+                # keep password_expires as is, only the hash format changes
+                self._password = new_hash
+            return True
+
+        if password_engine.verify(plain_text_password, self._temp_password):
+            # these are only good once
+            self.temp_password = None
+            return True
+
+        return False
 
     def __unicode__(self):
         return '{} {} ({})'.format(self.first_name, self.last_name, self.email)
@@ -49,7 +64,7 @@ class User(db.Model, db.Timestamp, db.HasProperties, db.FullText):
 
     @password.setter
     def password(self, plain_text_password):
-        self._password = pwd_context.hash(plain_text_password)
+        self._password = password_engine.hash(plain_text_password)
         self.password_expires = datetime.utcnow() + timedelta(days=365)
 
     password = synonym('_password', descriptor=password)
@@ -60,6 +75,10 @@ class User(db.Model, db.Timestamp, db.HasProperties, db.FullText):
 
     @temp_password.setter
     def temp_password(self, plain_text_password):
-        self._temp_password = pwd_context.hash(plain_text_password) if plain_text_password is not None else None
+        self._temp_password = password_engine.hash(plain_text_password) if plain_text_password is not None else None
 
     temp_password = synonym('_temp_password', descriptor=temp_password)
+
+
+# the user directory polls for recently modified users
+db.Index('ix_user_modified_at', User.modified_at)
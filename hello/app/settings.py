@@ -29,10 +29,51 @@ MAIL_SUBACCOUNT = os.getenv('MAIL_SUBACCOUNT', 'None')
 SESSION_LIMIT_TO_ONE = ast.literal_eval(os.getenv('SESSION_LIMIT_TO_ONE', 'True'))
 SESSION_MAX_AGE = ast.literal_eval(os.getenv('SESSION_MAX_AGE', str(30 * 60)))
 SESSION_MAX_IDLE = ast.literal_eval(os.getenv('SESSION_MAX_IDLE', str(30 * 24 * 60 * 60)))
+SESSION_TOKEN_CACHE_SIZE = ast.literal_eval(os.getenv('SESSION_TOKEN_CACHE_SIZE', '4096'))
+SESSION_REFRESH_ON_CHANGE = ast.literal_eval(os.getenv('SESSION_REFRESH_ON_CHANGE', 'False'))
+SESSION_REFRESH_FRACTION = ast.literal_eval(os.getenv('SESSION_REFRESH_FRACTION', '0.5'))
+SESSION_IDENTITY_CACHE_TTL = ast.literal_eval(os.getenv('SESSION_IDENTITY_CACHE_TTL', '60'))
+SESSION_IDENTITY_CACHE_SIZE = ast.literal_eval(os.getenv('SESSION_IDENTITY_CACHE_SIZE', '10000'))
+
+PASSWORD_ENGINE_WORKERS = ast.literal_eval(os.getenv('PASSWORD_ENGINE_WORKERS', '2'))
+PASSWORD_ENGINE_MAX_PENDING = ast.literal_eval(os.getenv('PASSWORD_ENGINE_MAX_PENDING', '8'))
+PASSWORD_ENGINE_TIMEOUT = ast.literal_eval(os.getenv('PASSWORD_ENGINE_TIMEOUT', '5'))
+PASSWORD_PBKDF2_ROUNDS = ast.literal_eval(os.getenv('PASSWORD_PBKDF2_ROUNDS', 'None'))
+
+ACTIVITY_TRACKING = ast.literal_eval(os.getenv('ACTIVITY_TRACKING', 'True'))
+ACTIVITY_FLUSH_INTERVAL = ast.literal_eval(os.getenv('ACTIVITY_FLUSH_INTERVAL', '5000'))
+ACTIVITY_FLUSH_MAX_USERS = ast.literal_eval(os.getenv('ACTIVITY_FLUSH_MAX_USERS', '500'))
+
+USER_DIRECTORY = ast.literal_eval(os.getenv('USER_DIRECTORY', 'True'))
+USER_DIRECTORY_REFRESH_INTERVAL = ast.literal_eval(os.getenv('USER_DIRECTORY_REFRESH_INTERVAL', '30'))
+USER_DIRECTORY_REBUILD_INTERVAL = ast.literal_eval(os.getenv('USER_DIRECTORY_REBUILD_INTERVAL', str(60 * 60)))
 
 MAX_CONTENT_LENGTH = ast.literal_eval(os.getenv('MAX_CONTENT_LENGTH', str(100 * 1024 * 1024)))
 
+BLOB_STORE_BACKEND = os.getenv('BLOB_STORE_BACKEND', 'app.utils.blob.LocalBlobStore')
+BLOB_STORE_PATH = os.getenv('BLOB_STORE_PATH', None)
+
+UPLOAD_SESSION_PATH = os.getenv('UPLOAD_SESSION_PATH', None)
+UPLOAD_SESSION_MAX_LENGTH = ast.literal_eval(os.getenv('UPLOAD_SESSION_MAX_LENGTH', str(2 * 1024 * 1024 * 1024)))
+UPLOAD_SESSION_MAX_AGE = ast.literal_eval(os.getenv('UPLOAD_SESSION_MAX_AGE', str(24 * 60 * 60)))
+
+IMAGE_MAX_PIXELS = ast.literal_eval(os.getenv('IMAGE_MAX_PIXELS', str(50 * 1000 * 1000)))
+IMAGE_QUALITY_PRESETS = ast.literal_eval(os.getenv(
+    'IMAGE_QUALITY_PRESETS', "{'default': {'jpeg': 82, 'webp': 78}, 'thumbnail': {'jpeg': 75, 'webp': 70}}"))
+IMAGE_DERIVATIVE_PRESETS = ast.literal_eval(os.getenv(
+    'IMAGE_DERIVATIVE_PRESETS', "{'thumbnail': (150, 150), 'medium': (800, 800)}"))
+IMAGE_DERIVATIVE_FORMATS = ast.literal_eval(os.getenv('IMAGE_DERIVATIVE_FORMATS', "('jpeg', 'webp')"))
+IMAGE_CACHE_PATH = os.getenv('IMAGE_CACHE_PATH', None)
+IMAGE_CACHE_MAX_SIZE = ast.literal_eval(os.getenv('IMAGE_CACHE_MAX_SIZE', str(1024 * 1024 * 1024)))
+IMAGE_CACHE_MAX_AGE = ast.literal_eval(os.getenv('IMAGE_CACHE_MAX_AGE', str(60 * 60)))
+
 CLAMAV_SERVER = os.getenv('CLAMAV_SERVER', None)
+CLAMAV_POOL_SIZE = ast.literal_eval(os.getenv('CLAMAV_POOL_SIZE', '4'))
+CLAMAV_TIMEOUT = ast.literal_eval(os.getenv('CLAMAV_TIMEOUT', '10'))
+CLAMAV_IDLE_TIMEOUT = ast.literal_eval(os.getenv('CLAMAV_IDLE_TIMEOUT', '25'))
+CLAMAV_ASYNC_THRESHOLD = ast.literal_eval(os.getenv('CLAMAV_ASYNC_THRESHOLD', str(10 * 1024 * 1024)))
+# clamd's StreamMaxLength, larger uploads are refused since they could never be scanned
+CLAMAV_STREAM_MAX_LENGTH = ast.literal_eval(os.getenv('CLAMAV_STREAM_MAX_LENGTH', str(25 * 1024 * 1024)))
 
 CELERY_TASK_ALWAYS_EAGER = ast.literal_eval(os.getenv('CELERY_TASK_ALWAYS_EAGER', 'False'))
 CELERY_BROKER_URL = 'amqp://{}:{}@{}:5672//'.format(
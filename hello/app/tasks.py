@@ -1,8 +1,110 @@
 # coding: utf-8
 
+import logging
+
+from werkzeug.exceptions import HTTPException, NotFound
+
+from app.extensions.clamav import clamav, ClamAVError, ClamAVSizeLimitError
 from app.extensions.flask_celery import celery
+from app.models import File
+from app.utils.database import db
+from app.utils.image import render_derivatives, RENDERABLE_MIMETYPES
+from app.utils.upload import purge_upload_sessions, UploadBusyException, UploadSession
+
+logger = logging.getLogger(__name__)
+
+# retried with backoff for about a day
+SCAN_RETRY_DELAY = 30
+SCAN_MAX_RETRY_DELAY = 60 * 60
+SCAN_MAX_RETRIES = 30
 
 
 @celery.task()
 def add(x, y):
     return x + y
+
+
+@celery.task(bind=True, max_retries=SCAN_MAX_RETRIES)
+def scan_file(self, file_id):
+    file = File.query.get(file_id)
+    if file is None or not file.quarantined:
+        return
+
+    try:
+        with file.open() as stream:
+            signature = clamav.scan(stream)
+    except ClamAVSizeLimitError as e:
+        # stored before uploads were held to clamd's limit, stays quarantined
+        logger.error('unable to scan file %s: %s', file_id, e)
+        file.properties['scan_error'] = str(e)
+        db.session.commit()
+        return
+    except ClamAVError as e:
+        # clamd is down or restarting, nothing else would ever take the file out of quarantine
+        logger.warning('unable to scan file %s: %s', file_id, e)
+        raise self.retry(exc=e, countdown=min(SCAN_RETRY_DELAY * 2 ** self.request.retries, SCAN_MAX_RETRY_DELAY))
+
+    if signature:
+        # stays quarantined
+        logger.warning('virus %s detected in file %s', signature, file_id)
+        file.properties['virus'] = signature
+    else:
+        file.quarantined = False
+
+    db.session.commit()
+
+    if not file.quarantined and file.mimetype in RENDERABLE_MIMETYPES:
+        render_image_derivatives.delay(file.id)
+
+
+@celery.task()
+def render_image_derivatives(file_id):
+    file = File.query.get(file_id)
+    if file is None or file.quarantined:
+        return
+
+    try:
+        derivatives = render_derivatives(file)
+    except (IOError, SyntaxError):
+        # Pillow's way of saying the contents aren't an image it understands
+        logger.warning('unable to render derivatives of file %s', file_id, exc_info=True)
+        return
+
+    file.properties['derivatives'] = derivatives
+    db.session.commit()
+
+
+@celery.task(bind=True, max_retries=10)
+def finalize_upload(self, upload_id):
+    try:
+        session = UploadSession.get(upload_id)
+    except NotFound:
+        # purged meanwhile
+        return
+    if session.state != UploadSession.FINALIZING:
+        return
+
+    try:
+        file = session.finalize()
+        db.session.add(file)
+        db.session.commit()
+    except UploadBusyException as e:
+        # a last PATCH still holds the lock
+        raise self.retry(exc=e, countdown=5)
+    except ClamAVError as e:
+        raise self.retry(exc=e, countdown=60)
+    except HTTPException as e:
+        # refused: extension, MIME type, virus...
+        db.session.rollback()
+        logger.info('upload %s refused: %s', upload_id, e.description)
+        session.finish(error=e.description)
+        return
+
+    session.finish(file_id=file.id)
+
+
+@celery.task()
+def purge_stale_uploads():
+    purged = purge_upload_sessions()
+    if purged:
+        logger.info('purged %d stale upload sessions', purged)
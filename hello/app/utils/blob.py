@@ -0,0 +1,129 @@
+# coding: utf-8
+"""Content-addressed blob storage.
+
+Blobs are immutable and identified by the SHA-256 hex digest of their content, so storing the
+same bytes twice keeps a single copy.  Blobs are never deleted when a referencing row goes away
+since other rows may share them.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobWriter(object):
+    """Incrementally writes one blob, hashing it on the way.  Use as a context manager."""
+
+    def __init__(self):
+        self.size = 0
+        self.digest = None
+        self._hash = hashlib.sha256()
+
+    def write(self, chunk):
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        self._write(chunk)
+
+    def commit(self):
+        """Finish the blob, returning its digest."""
+        self.digest = self._hash.hexdigest()
+        self._commit(self.digest)
+        return self.digest
+
+    def abort(self):
+        pass
+
+    def _write(self, chunk):
+        raise NotImplementedError
+
+    def _commit(self, digest):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None or self.digest is None:
+            self.abort()
+
+
+class BlobStore(object):
+    """Interface every storage backend implements."""
+
+    def writer(self):
+        raise NotImplementedError
+
+    def open(self, digest):
+        """Return a readable binary file object for the blob."""
+        raise NotImplementedError
+
+    def exists(self, digest):
+        raise NotImplementedError
+
+    def path(self, digest):
+        """Local filesystem path of the blob when the backend has one, so it can be served with sendfile."""
+        return None
+
+    def put(self, stream, chunk_size=CHUNK_SIZE):
+        """Store everything read from `stream`, returning `(digest, size)`."""
+        with self.writer() as writer:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                writer.write(chunk)
+            writer.commit()
+        return writer.digest, writer.size
+
+
+class LocalBlobWriter(BlobWriter):
+
+    def __init__(self, store):
+        super().__init__()
+        self._store = store
+        self._file = tempfile.NamedTemporaryFile(dir=store.tmp_path, delete=False)
+
+    def _write(self, chunk):
+        self._file.write(chunk)
+
+    def _commit(self, digest):
+        self._file.close()
+
+        target = self._store.path(digest)
+        if os.path.exists(target):
+            # identical content is already stored
+            os.unlink(self._file.name)
+            return
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(self._file.name, target)
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self._file.name)
+        except FileNotFoundError:
+            pass
+
+
+class LocalBlobStore(BlobStore):
+    """Stores blobs on local disk as `<root>/ab/cd/abcd...`."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.tmp_path = os.path.join(self.root, 'tmp')
+        os.makedirs(self.tmp_path, exist_ok=True)
+
+    def writer(self):
+        return LocalBlobWriter(self)
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
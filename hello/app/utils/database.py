@@ -1,23 +1,35 @@
 # coding: utf-8
 
+import base64
+from contextlib import contextmanager
 from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+import json
 import logging
 import re
+import unicodedata
+import zlib
 
 from flask import g
 from flask_sqlalchemy import BaseQuery as SQLABaseQuery, SQLAlchemy
-from sqlalchemy import literal, MetaData
+from sqlalchemy import and_, cast, event, false, Float, func, inspect, literal, MetaData, Numeric, or_, select, text
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy.orm import validates
-from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.orm import Session, undefer_group, validates
+from sqlalchemy.schema import FetchedValue
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import ColumnElement
+from werkzeug.exceptions import BadRequest
 
-from .sqlalchemy_json import NestedJsonObject
+from .security import encoder
+from .sqlalchemy_json import GeneratedType, json_path, json_property_expression, NestedJsonObject
 
 logger = logging.getLogger(__name__)
 
 first_cap_re = re.compile('(.)([A-Z][a-z]+)')
 all_cap_re = re.compile('([a-z0-9])([A-Z])')
+boolean_operators_re = re.compile(r'[-+<>()~*"@]+')
 
 
 def convert_to_underscore(name):
@@ -43,6 +55,57 @@ db = SQLAlchemy(metadata=metadata)
 db.NestedJsonObject = NestedJsonObject
 
 
+def call_after_commit(session, func, *args, **kwargs):
+    """Call `func` once the session's outermost transaction has committed and ended, or never if it rolls back.
+
+    The session can't emit SQL while it is committing, so callbacks run after the transaction is over.  Any
+    database work they do belongs in a session of its own, see `separate_session()`.
+    """
+    session.info.setdefault('after_commit', []).append((func, args, kwargs))
+
+
+@contextmanager
+def separate_session():
+    """Run the block with a new `db.session`, putting back the current one afterwards."""
+    registry = db.session.registry
+    current = registry() if registry.has() else None
+    registry.clear()
+    try:
+        yield db.session
+    finally:
+        db.session.remove()
+        if current is not None:
+            registry.set(current)
+
+
+@event.listens_for(Session, 'after_commit')
+def _hold_after_commit(session):
+    # savepoints commit too, only the outermost transaction counts
+    if session.transaction.parent is None:
+        session.info['committed'] = session.info.pop('after_commit', [])
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _run_after_commit(session, transaction):
+    if transaction.parent is not None:
+        return
+
+    # left over when the transaction is closed without a commit or rollback
+    session.info.pop('after_commit', None)
+
+    for callback, args, kwargs in session.info.pop('committed', []):
+        try:
+            callback(*args, **kwargs)
+        except Exception:
+            # the data is already committed, don't fail the caller over a side effect
+            logger.exception('after commit callback %r failed', callback)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_commit(session):
+    session.info.pop('after_commit', None)
+
+
 def real_user_id():
     if g.real_user:
         return g.real_user.id
@@ -69,11 +132,20 @@ class FullText(object):
         return (db.Index('search', *self.__fulltext_columns__, mysql_prefix="FULLTEXT"),)
 
 
-class FullTextSearch(ClauseElement):
-    def __init__(self, against, model, alias=None):
+def prefix_search_terms(text):
+    """`text` as a boolean mode query that requires every word, each as a prefix: `+word*`."""
+    return ' '.join('+{}*'.format(x) for x in boolean_operators_re.sub(' ', text).split())
+
+
+class FullTextSearch(ColumnElement):
+    """`MATCH ... AGAINST`, usable as a filter and as the relevance score."""
+    type = Float()
+
+    def __init__(self, against, model, alias=None, boolean=False):
         self.alias = alias
         self.model = model
         self.against = literal(against)
+        self.boolean = boolean
 
 
 def get_table_name(element):
@@ -85,14 +157,154 @@ def get_table_name(element):
 
 
 @compiles(FullTextSearch, 'mysql')
-def mysql_fulltext_search(element, compiler):
-    return u"MATCH ({0}) AGAINST ({1})".format(
+def mysql_fulltext_search(element, compiler, **kw):
+    return u"MATCH ({0}) AGAINST ({1}{2})".format(
         ", ".join([get_table_name(element) + column for column in element.model.__fulltext_columns__]),
-        compiler.process(element.against))
+        compiler.process(element.against, **kw), ' IN BOOLEAN MODE' if element.boolean else '')
+
+
+trigram_table = db.Table(
+    'trigram',
+    db.Column('owner', db.String(128), primary_key=True),
+    db.Column('trigram', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('row_id', db.Integer, primary_key=True, autoincrement=False, index=True))
+
+
+# utf8_general_ci weighs it as S, not SS
+_COLLATION_EXCEPTIONS = {'ß': 's'}
+
+
+@lru_cache(maxsize=4096)
+def _fold_char(c):
+    if c in _COLLATION_EXCEPTIONS:
+        return _COLLATION_EXCEPTIONS[c]
+
+    folded = []
+    for base in unicodedata.normalize('NFKD', c):
+        if unicodedata.combining(base):
+            continue
+        # the simple one-to-one uppercase the collation weighs by, so ı and I or ς and σ fold alike
+        upper = base.upper()
+        if len(upper) == 1:
+            base = upper
+        folded.extend(x for x in unicodedata.normalize('NFKD', base.lower()) if not unicodedata.combining(x))
+    return ''.join(folded)
+
+
+def fold_text(value):
+    """`value` folded so that characters utf8_general_ci compares equal come out the same.
+
+    The collation gives each character a single weight, its uppercased base letter.  This folds
+    character by character to the lowercase of that, so it can only equate more than the collation
+    does, never less: the trigrams of a row always include those of any text LIKE finds in it.
+    """
+    return ''.join(_fold_char(c) for c in value)
+
+
+def trigrams(value):
+    """Hashes of the distinct trigrams of `value`, folded with `fold_text()`."""
+    if not value:
+        return set()
+    value = fold_text(value)
+    return {zlib.crc32(value[i:i + 3].encode('utf-8')) & 0x7fffffff for i in range(len(value) - 2)}
+
+
+class Trigram(object):
+    """Indexes `__trigram_columns__` in the `trigram` table, so `BaseQuery.contains()` on them doesn't scan."""
+    __trigram_columns__ = tuple()
+
+
+def _trigram_owner(model, column):
+    return '{}.{}'.format(model.__table__.name, column)
+
+
+def _insert_trigrams(connection, model, row_id, column, keys):
+    if keys:
+        owner = _trigram_owner(model, column)
+        connection.execute(trigram_table.insert(), [{'owner': owner, 'trigram': x, 'row_id': row_id} for x in keys])
+
+
+def _delete_trigrams(connection, model, row_ids, columns, keys=None):
+    clause = and_(
+        trigram_table.c.owner.in_([_trigram_owner(model, x) for x in columns]), trigram_table.c.row_id.in_(row_ids))
+    if keys is not None:
+        clause = and_(clause, trigram_table.c.trigram.in_(keys))
+    connection.execute(trigram_table.delete().where(clause))
+
+
+@event.listens_for(Trigram, 'after_insert', propagate=True)
+def _index_trigrams(mapper, connection, target):
+    for column in target.__trigram_columns__:
+        _insert_trigrams(connection, type(target), target.id, column, trigrams(getattr(target, column)))
+
+
+@event.listens_for(Trigram, 'after_update', propagate=True)
+def _reindex_trigrams(mapper, connection, target):
+    state = inspect(target)
+    for column in target.__trigram_columns__:
+        history = state.attrs[column].history
+        if not history.has_changes():
+            continue
+
+        keys = trigrams(getattr(target, column))
+        if history.deleted:
+            # only what the change added or removed
+            previous = trigrams(history.deleted[0])
+            if previous - keys:
+                _delete_trigrams(connection, type(target), [target.id], [column], previous - keys)
+            keys = keys - previous
+        else:
+            _delete_trigrams(connection, type(target), [target.id], [column])
+        _insert_trigrams(connection, type(target), target.id, column, keys)
+
+
+@event.listens_for(Trigram, 'after_delete', propagate=True)
+def _unindex_trigrams(mapper, connection, target):
+    _delete_trigrams(connection, type(target), [target.id], target.__trigram_columns__)
+
+
+def rebuild_trigrams(model, batch_size=1000):
+    """Index every row of `model` again, after changing `__trigram_columns__` or writing around the ORM.
+
+    Works through the table a batch per transaction, so `contains()` keeps using the index meanwhile.
+    Returns the number of rows indexed.
+    """
+    columns = model.__trigram_columns__
+    query = model.query.with_entities(model.id, *[getattr(model, x) for x in columns])
+
+    after, count = None, 0
+    while True:
+        rows, after = query.seek(after=after, per_page=batch_size)
+        if rows:
+            connection = db.session.connection()
+            _delete_trigrams(connection, model, [row.id for row in rows], columns)
+            params = [
+                {'owner': _trigram_owner(model, column), 'trigram': x, 'row_id': row.id}
+                for row in rows for column in columns for x in trigrams(getattr(row, column))]
+            if params:
+                connection.execute(trigram_table.insert(), params)
+            db.session.commit()
+        count += len(rows)
+        if after is None:
+            break
+
+    # rows deleted around the ORM
+    db.session.connection().execute(trigram_table.delete().where(and_(
+        trigram_table.c.owner.in_([_trigram_owner(model, x) for x in columns]),
+        ~trigram_table.c.row_id.in_(select([model.id])))))
+    db.session.commit()
+    return count
 
 
 class HasProperties(object):
-    properties = db.Column(db.NestedJsonObject, default=dict, server_default=None)
+
+    @declared_attr
+    def properties(self):
+        # deferred, most queries never look at it; see BaseQuery.with_properties()
+        # rewritten whole until it is migrated to a native JSON column, plain for filter_property()
+        return db.deferred(
+            db.Column(db.NestedJsonObject(compress=False), default=dict, server_default=None),
+            group='properties')
 
     @validates('properties')
     def validate_properties(self, key, properties):
@@ -105,19 +317,228 @@ class Timestamp(object):
     modified_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
+def property_column(path, type_, column='properties', index=True):
+    """An indexed generated column holding the JSON property at dotted `path` of `column`.
+
+    `BaseQuery.filter_property()` filters on it instead of digging into the documents, which needs
+    `column` to be a `NestedJsonObject(native=True)` to be indexable.
+    """
+    return db.Column(
+        GeneratedType(type_, json_property_expression(column, path)),
+        index=index,
+        server_default=FetchedValue(),
+        server_onupdate=FetchedValue(),
+        info={'property_path': path, 'property_column': column})
+
+
+# MATCH scores are floats, which don't survive the round trip through a token exactly
+SEARCH_SCORE_TYPE = Numeric(30, 12)
+
+
+class InvalidSeekTokenException(BadRequest):
+    pass
+
+
+def _encode_seek_value(value):
+    if isinstance(value, datetime):
+        return ['d', value.isoformat()]
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return ['i', encoder.encode_hex(value)]
+    if isinstance(value, Decimal):
+        return ['n', str(value)]
+    return ['v', value]
+
+
+def _decode_seek_value(kind, value):
+    if kind == 'd':
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+    if kind == 'i':
+        return encoder.decode_hex(value)
+    if kind == 'n':
+        return Decimal(value)
+    if kind == 'v':
+        return value
+    raise ValueError(kind)
+
+
+def _seek_equal(key, value):
+    column = key[1]
+    return column.is_(None) if value is None else column == value
+
+
+def _seek_past(key, value):
+    """Rows sorting strictly after `value` on `key`, NULLs being the lowest value."""
+    key, column, descending, nullable = key
+    if value is None:
+        return false() if descending else column.isnot(None)
+    if descending:
+        return or_(column < value, column.is_(None)) if nullable else column < value
+    return column > value
+
+
+def encode_seek_token(values):
+    """Opaque continuation token for the keyset `values` of the last row of a page."""
+    data = json.dumps([_encode_seek_value(x) for x in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_seek_token(token):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+        return [_decode_seek_value(kind, value) for kind, value in data]
+    except (TypeError, ValueError):
+        raise InvalidSeekTokenException('Invalid continuation token.')
+
+
 db.Audit = Audit
 db.FullText = FullText
 db.HasProperties = HasProperties
+db.Trigram = Trigram
 db.Timestamp = Timestamp
+db.property_column = property_column
 
 
 class BaseQuery(SQLABaseQuery):
 
-    def search(self, text, model, alias=None):
-        return self.filter(FullTextSearch(text, model, alias=alias))
+    def search(self, text, model, alias=None, boolean=False):
+        return self.filter(FullTextSearch(text, model, alias=alias, boolean=boolean))
+
+    def ranked_search(self, text, model, after=None):
+        """Rows of `model` matching every word of `text` as a prefix, best first.
+
+        Each row comes with its relevance as a `score` column, a DECIMAL so that it compares exactly
+        when passed back.  Pages follow on from the `(score, id)` of the last row seen, passed as
+        `after`, rather than an OFFSET.
+        """
+        match = FullTextSearch(prefix_search_terms(text), model, boolean=True)
+        score = cast(match, SEARCH_SCORE_TYPE)
+        query = self.add_columns(score.label('score')).filter(match)
+
+        if after is not None:
+            last_score, last_id = after
+            query = query.filter(or_(score < last_score, and_(score == last_score, model.id < last_id)))
+
+        return query.order_by(score.desc(), model.id.desc())
+
+    def search_page(self, text, model, after=None, per_page=20):
+        """One page of `ranked_search()`: `([(row, score), ...], token)`, `token` being None on the last page.
+
+        Like `seek()`, the next page is the one following on from the `token` passed as `after`.
+        """
+        if after is not None:
+            after = decode_seek_token(after)
+            if len(after) != 2:
+                raise InvalidSeekTokenException('Invalid continuation token.')
+
+        rows = [tuple(x) for x in self.ranked_search(text, model, after=after).limit(per_page + 1)]
+
+        token = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            token = encode_seek_token([rows[-1][1], rows[-1][0].id])
+
+        return rows, token
+
+    def _seek_keys(self, order_by):
+        """`[(attribute name, column, descending, nullable), ...]` for `order_by`, ending with the primary key."""
+        model = self.column_descriptions[0]['entity']
+        keys = []
+        for item in order_by or ('id', ):
+            descending = False
+            if isinstance(item, str):
+                descending = item.startswith('-')
+                item = getattr(model, item.lstrip('-'))
+            elif getattr(item, 'modifier', None) in (operators.desc_op, operators.asc_op):
+                descending = item.modifier is operators.desc_op
+                item = item.element
+            column = item.property.columns[0] if hasattr(item, 'property') else item
+            keys.append((item.key, item, descending, getattr(column, 'nullable', True)))
+
+        if 'id' not in [x[0] for x in keys]:
+            # the last key must be unique for the order to be total
+            keys.append(('id', model.id, keys[-1][2] if keys else False, False))
+        return keys
+
+    def seek(self, after=None, order_by=None, per_page=20):
+        """One page in keyset order: `(rows, token)`, `token` being None on the last page.
+
+        `order_by` lists attributes, names (`'-created_at'` for descending) or `desc()` clauses, the
+        primary key being added as a tie breaker.  NULLs sort first, as MySQL does.  The next page is
+        the one following on from the `token` passed as `after`, so it costs the same as the first one
+        as long as the keys are indexed together.
+        """
+        keys = self._seek_keys(order_by)
+        query = self
+
+        if after is not None:
+            values = decode_seek_token(after)
+            if len(values) != len(keys):
+                raise InvalidSeekTokenException('Invalid continuation token.')
+
+            # (a, b) > (x, y) spelled out, with the first key bounded on its own so it's usable as a range
+            clauses = []
+            for i, (key, value) in enumerate(zip(keys, values)):
+                equal = [_seek_equal(k, v) for k, v in zip(keys[:i], values[:i])]
+                clauses.append(and_(*equal + [_seek_past(key, value)]))
+
+            query = query.filter(or_(_seek_equal(keys[0], values[0]), _seek_past(keys[0], values[0])))
+            query = query.filter(or_(*clauses))
+
+        query = query.order_by(*[x[1].desc() if x[2] else x[1] for x in keys])
+
+        rows = query.limit(per_page + 1).all()
+        token = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            token = encode_seek_token([getattr(rows[-1], x[0]) for x in keys])
+
+        return rows, token
+
+    def approximate_count(self):
+        """Row count of the queried table from the MySQL table statistics, which skips the scan
+        `COUNT(*)` makes at the cost of being off by a few percent.  Only meaningful unfiltered.
+        """
+        model = self.column_descriptions[0]['entity']
+        if self.session.get_bind(mapper=inspect(model)).dialect.name != 'mysql':
+            return self.order_by(None).count()
+
+        return self.session.execute(
+            text('SELECT TABLE_ROWS FROM information_schema.TABLES '
+                 'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name'),
+            {'name': model.__table__.name}).scalar()
 
     def contains(self, column, text):
-        return self.filter(column.contains(_escaped(text, '\\')))
+        """Rows whose `column` contains `text`.
+
+        For a `Trigram` column, rows having every trigram of `text` are looked up in the index first and
+        only those are checked with LIKE.  Shorter than a trigram, it's a LIKE scan.
+        """
+        clause = column.contains(_escaped(text, '\\'))
+
+        model, keys = getattr(column, 'class_', None), trigrams(text)
+        if keys and isinstance(model, type) and issubclass(model, Trigram) and column.key in model.__trigram_columns__:
+            candidates = select([trigram_table.c.row_id]).where(and_(
+                trigram_table.c.owner == _trigram_owner(model, column.key),
+                trigram_table.c.trigram.in_(keys))).group_by(trigram_table.c.row_id).having(func.count() == len(keys))
+            # joined as a derived table, MySQL 5.7 runs IN (... GROUP BY) once per row of the outer query
+            candidates = candidates.alias('trigram_candidates')
+            return self.join(candidates, model.id == candidates.c.row_id).filter(clause)
+
+        return self.filter(clause)
+
+    def with_properties(self):
+        """Load the deferred `HasProperties.properties` along with the rows."""
+        return self.options(undefer_group('properties'))
+
+    def filter_property(self, path, value, column='properties'):
+        """Filter on the JSON property at dotted `path`, using the model's `property_column()` for it if any."""
+        model = self.column_descriptions[0]['entity']
+        for c in inspect(model).columns:
+            if c.info.get('property_path') == path and c.info.get('property_column') == column:
+                return self.filter(c == value)
+
+        expression = func.json_unquote(func.json_extract(getattr(model, column), json_path(path)))
+        return self.filter(expression == value)
 
 
 class BaseModel(object):
@@ -1,21 +1,28 @@
 # coding: utf-8
 
-import base64
-from io import BytesIO
 import logging
 import mimetypes
 
 from os import path
 
-from flask import send_file as _send_file
+from flask import has_request_context, request, send_file as _send_file
 import magic
-from werkzeug.exceptions import UnsupportedMediaType
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from werkzeug.exceptions import Forbidden, RequestEntityTooLarge, UnsupportedMediaType
 from werkzeug.utils import secure_filename
 
+from app.extensions.blob_store import blob_store
+from app.extensions.clamav import clamav
 from app.models import File
+from app.utils.blob import CHUNK_SIZE
+from app.utils.database import call_after_commit
+from app.utils.image import RENDERABLE_MIMETYPES
 
 logger = logging.getLogger(__name__)
 
+MIMETYPE_SNIFF_SIZE = 1024
+
 _default_upload_mime_types_blacklist = {
     'application/bat', 'application/vnd.ms-cab-compressed', 'application/x-bat', 'application/x-dosexec',
     'application/x-msdos-program', 'application/x-msdownload'
@@ -41,22 +48,103 @@ class VirusDetectedInFileException(Exception):
     pass
 
 
+class FileQuarantinedException(Forbidden):
+    pass
+
+
+class FileTooLargeToScanException(RequestEntityTooLarge):
+    pass
+
+
 def send_file(file, *args, **kwargs):
-    kwargs.setdefault('mimetype', mimetypes.guess_type(file.name)[0])
+    if file.quarantined:
+        raise FileQuarantinedException('File is still being scanned for viruses, please try again later.')
+
+    kwargs.setdefault('mimetype', file.mimetype or mimetypes.guess_type(file.name)[0])
 
-    return _send_file(BytesIO(base64.b64decode(file.properties['data'])), *args, **kwargs)
+    # a path lets werkzeug hand the file to wsgi.file_wrapper (sendfile) instead of copying it through python
+    return _send_file(file.path or file.open(), *args, **kwargs)
 
 
-def upload_file(file):
+def upload_file(file, scan=True, chunk_size=CHUNK_SIZE):
+    """Store an uploaded file, reading its stream exactly once.
+
+    In the same pass over fixed size chunks this sniffs the MIME type from the head of the file,
+    applies the extension and MIME blacklists, hashes and writes the contents to the blob store and,
+    with `CLAMAV_SERVER` set, streams every chunk to clamd.  Uploads larger than
+    `CLAMAV_ASYNC_THRESHOLD`, or of unknown length, are instead stored quarantined and scanned by a
+    celery task once the `File` is committed.  Uploads clamd won't take, longer than
+    `CLAMAV_STREAM_MAX_LENGTH`, are refused.  Nothing is kept if any check fails.
+    """
     filename = secure_filename(file.filename)
     if not is_extension_allowed(filename):
         raise FileExtensionNotAllowedException("Given filename's extension not allowed for upload.")
 
-    mimetype = guess_mimetype(file)
+    scanner = None
+    quarantined = False
+    max_length = None
+    if scan and clamav.enabled:
+        max_length = clamav.stream_max_length
+        length = _upload_length(file)
+        if length is not None and max_length and length > max_length:
+            raise FileTooLargeToScanException('File is too large to be scanned for viruses.')
+        if length is None or length > clamav.async_threshold:
+            quarantined = True
+        else:
+            scanner = clamav.scanner()
+
+    mimetype = None
+    head = b''
+    length = 0
+    try:
+        with blob_store.writer() as writer:
+            for chunk in iter(lambda: file.stream.read(chunk_size), b''):
+                length += len(chunk)
+                if max_length and length > max_length:
+                    raise FileTooLargeToScanException('File is too large to be scanned for viruses.')
+
+                if mimetype is None:
+                    head += chunk[:MIMETYPE_SNIFF_SIZE - len(head)]
+                    if len(head) >= MIMETYPE_SNIFF_SIZE:
+                        mimetype = _check_mimetype(head)
+
+                if scanner is not None:
+                    scanner.feed(chunk)
+                writer.write(chunk)
+
+            if mimetype is None:
+                # smaller than the sniff size
+                mimetype = _check_mimetype(head)
+
+            if scanner is not None:
+                signature = scanner.finish()
+                if signature:
+                    raise VirusDetectedInFileException('Virus detected in file: {}'.format(signature))
+
+            writer.commit()
+    except Exception:
+        if scanner is not None:
+            scanner.abort()
+        raise
+
+    return File(
+        name=filename, mimetype=mimetype, digest=writer.digest, size=writer.size, quarantined=quarantined)
+
+
+def _upload_length(file):
+    """The length the client announced, or None."""
+    if file.content_length:
+        return file.content_length
+    if has_request_context() and request.content_length:
+        return request.content_length
+    return None
+
+
+def _check_mimetype(head):
+    mimetype = magic.from_buffer(head, mime=True)
     if not is_mimetype_allowed(mimetype):
         raise MimeTypeNotAllowedException('Auto-detected MIME type not allowed for upload.')
-
-    return File(name=filename, stream=file)
+    return mimetype
 
 
 def guess_mimetype(file):
@@ -75,3 +163,18 @@ def is_mimetype_allowed(mimetype):
 def is_extension_allowed(filename):
     name, ext = path.splitext(filename)
     return ext not in _default_upload_extensions_blacklist
+
+
+@event.listens_for(File, 'after_insert')
+def _scan_quarantined_file(mapper, connection, target):
+    if target.quarantined:
+        from app.tasks import scan_file
+        call_after_commit(object_session(target), scan_file.delay, target.id)
+
+
+@event.listens_for(File, 'after_insert')
+def _render_image_derivatives(mapper, connection, target):
+    # quarantined images are rendered once the scan clears them
+    if not target.quarantined and target.mimetype in RENDERABLE_MIMETYPES:
+        from app.tasks import render_image_derivatives
+        call_after_commit(object_session(target), render_image_derivatives.delay, target.id)
@@ -0,0 +1,155 @@
+# coding: utf-8
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import object_session
+
+from app.models import User
+from app.utils.database import call_after_commit, db
+
+logger = logging.getLogger(__name__)
+
+IDENTITY_FIELDS = ('id', 'email', 'first_name', 'last_name', 'is_staff', 'is_active', 'tick')
+
+
+class UserIdentity(object):
+    """Lightweight, read-only snapshot of the `User` fields needed to authenticate a request.
+
+    Reading any other attribute, or writing any attribute, loads the full `User` row and from
+    then on the snapshot simply proxies to it, so views that need to write get a real ORM
+    instance without having to ask for one.
+    """
+
+    def __init__(self, values):
+        self.__dict__['_values'] = values
+        self.__dict__['_instance'] = None
+
+    def materialize(self):
+        instance = self.__dict__['_instance']
+        if instance is None:
+            instance = self.__dict__['_instance'] = User.query.get(self._values['id'])
+        return instance
+
+    def __getattr__(self, name):
+        if self.__dict__['_instance'] is None and name in self._values:
+            return self._values[name]
+        return getattr(self.materialize(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.materialize(), name, value)
+
+    def __eq__(self, other):
+        if isinstance(other, (UserIdentity, User)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __ne__(self, other):
+        rv = self.__eq__(other)
+        return rv if rv is NotImplemented else not rv
+
+    def __hash__(self):
+        return hash((User, self._values['id']))
+
+    def __repr__(self):
+        return '<UserIdentity {}>'.format(self._values['id'])
+
+
+def materialize(user):
+    """Return the ORM instance behind `user`, loading it if it is still a snapshot."""
+    if isinstance(user, UserIdentity):
+        return user.materialize()
+    return user
+
+
+class IdentityCache(object):
+    """Per-process cache of `UserIdentity` snapshots with a TTL.
+
+    Changes made through the ORM in this process invalidate entries once they commit (see the
+    `User` mapper events below); changes made elsewhere are picked up once the TTL lapses, or
+    right away for a user whose `tick` doesn't match the one the caller expects.
+    """
+
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, ids, ticks=None):
+        """Snapshots of the users with `ids` that exist, by id.
+
+        `ticks` maps ids to the `tick` the caller expects, e.g. from a session cookie; a cached
+        snapshot with a different one is read again, since another process may have bumped it.
+        """
+        now = time.time()
+        found = {}
+        missing = []
+        ticks = ticks or {}
+
+        with self._lock:
+            for id in ids:
+                entry = self._entries.get(id)
+                if entry is not None and entry[0] > now and ticks.get(id, entry[1]['tick']) == entry[1]['tick']:
+                    found[id] = UserIdentity(entry[1])
+                else:
+                    missing.append(id)
+
+            self.hits += len(found)
+            self.misses += len(missing)
+            generation = self._generation
+
+        if missing:
+            columns = [getattr(User, name) for name in IDENTITY_FIELDS]
+            rows = [dict(zip(IDENTITY_FIELDS, x)) for x in db.session.query(*columns).filter(User.id.in_(missing))]
+
+            with self._lock:
+                # an invalidation raced with the query, so don't keep what we read
+                store = self.ttl > 0 and generation == self._generation
+                for values in rows:
+                    found[values['id']] = UserIdentity(values)
+                    if store:
+                        self._entries[values['id']] = (now + self.ttl, values)
+                        self._entries.move_to_end(values['id'])
+
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+        return found
+
+    def invalidate(self, id):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+identity_cache = IdentityCache()
+
+
+# invalidated once committed, otherwise a concurrent request could read and cache the row as it was
+# before the commit, after the invalidation
+
+
+@event.listens_for(User, 'after_update')
+def _invalidate_updated_user(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in IDENTITY_FIELDS):
+        call_after_commit(object_session(target), identity_cache.invalidate, target.id)
+
+
+@event.listens_for(User, 'after_delete')
+def _invalidate_deleted_user(mapper, connection, target):
+    call_after_commit(object_session(target), identity_cache.invalidate, target.id)
@@ -1,40 +1,101 @@
 # coding: utf-8
 
-import base64
+import hashlib
 from io import BytesIO
+import math
 
-from flask import send_file
-from PIL import ExifTags, Image, ImageOps
+from flask import current_app, request, send_file
+from PIL import Image, ImageOps
+from werkzeug.exceptions import UnprocessableEntity
+from werkzeug.wrappers import Response
 
+from app.extensions.blob_store import blob_store
+from app.extensions.image_cache import image_cache
 
-def _handle_rotation(im):
+
+ORIENTATION_TAG = 0x0112
+
+# transposes that undo each EXIF orientation; 5 and 7 are the transpose and transverse
+_ORIENTATION_TRANSPOSES = {
+    2: (Image.FLIP_LEFT_RIGHT, ),
+    3: (Image.ROTATE_180, ),
+    4: (Image.FLIP_TOP_BOTTOM, ),
+    5: (Image.ROTATE_90, Image.FLIP_TOP_BOTTOM),
+    6: (Image.ROTATE_270, ),
+    7: (Image.ROTATE_90, Image.FLIP_LEFT_RIGHT),
+    8: (Image.ROTATE_90, ),
+}
+
+
+# what Pillow can open, anything else is never pre-rendered
+RENDERABLE_MIMETYPES = {'image/bmp', 'image/gif', 'image/jpeg', 'image/png', 'image/tiff', 'image/webp'}
+
+
+class ImageTooLargeException(UnprocessableEntity):
+    pass
+
+
+class FullImage(object):
+    """An uncropped image over a whole `File`, for places that have no crop box."""
+
+    top_left_x = top_left_y = 0.0
+    bottom_right_x = bottom_right_y = 1.0
+
+    def __init__(self, file):
+        self.file = file
+
+
+def _orientation(im):
     if not hasattr(im, '_getexif'):
-        return im
+        return 1
+
+    try:
+        exif = im._getexif()
+    except Exception:
+        # broken EXIF data shouldn't make the image unusable
+        return 1
+
+    return (exif or {}).get(ORIENTATION_TAG, 1)
 
-    for orientation in ExifTags.TAGS.keys():
-        if ExifTags.TAGS[orientation] == 'Orientation':
-            if im._getexif():
-                exif = dict(im._getexif().items())
 
-                if orientation in exif:
-                    if exif[orientation] == 3:
-                        im = im.rotate(180, expand=True)
-                    elif exif[orientation] == 6:
-                        im = im.rotate(270, expand=True)
-                    elif exif[orientation] == 8:
-                        im = im.rotate(90, expand=True)
+def _handle_rotation(im, orientation=None):
+    if orientation is None:
+        orientation = _orientation(im)
+
+    for method in _ORIENTATION_TRANSPOSES.get(orientation, ()):
+        im = im.transpose(method)
 
     return im
 
 
-def open_image(image):
-    stream = BytesIO(base64.b64decode(image.file.properties['data']))
-    im = Image.open(stream)
-    im = _handle_rotation(im)
+def open_image(image, size=None):
+    """Open, orient and crop `image`.
+
+    When the final `size` is known, JPEGs are decoded straight at the smallest scale that still
+    covers it (libjpeg can scale by 1/2, 1/4 and 1/8 while decoding), and nothing larger than
+    `IMAGE_MAX_PIXELS` is ever decoded.
+    """
+    im = Image.open(image.file.open())
+    orientation = _orientation(im)
 
     wp = image.bottom_right_x - image.top_left_x
     hp = image.bottom_right_y - image.top_left_y
 
+    if size and im.format == 'JPEG':
+        width, height = size
+        if orientation in (5, 6, 7, 8):
+            # the size is wanted after rotation, the draft works on the stored image
+            width, height = height, width
+            wp, hp = hp, wp
+        im.draft(im.mode, (int(math.ceil(width / wp)), int(math.ceil(height / hp))))
+        wp = image.bottom_right_x - image.top_left_x
+        hp = image.bottom_right_y - image.top_left_y
+
+    if im.size[0] * im.size[1] > current_app.config['IMAGE_MAX_PIXELS']:
+        raise ImageTooLargeException('Image is too large to process.')
+
+    im = _handle_rotation(im, orientation)
+
     if wp == 1 and hp == 1:
         # full size in both direction
         return im
@@ -56,11 +117,162 @@ def fit_image(*args, **kwargs):
     return ImageOps.fit(*args, **kwargs)
 
 
-def send_image(im, *args, **kwargs):
+MIMETYPES = {
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+
+def _webp_supported():
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def negotiate_format():
+    """Pick the output format for the current request from its `Accept` header.
+
+    Only an explicit `image/webp` counts, browsers send `*/*` whether they can decode WebP or not.
+    """
+    if _webp_supported():
+        for value, quality in request.accept_mimetypes:
+            if value == 'image/webp' and quality:
+                return 'webp'
+    return 'jpeg'
+
+
+def image_quality(format, preset=None):
+    """Quality for `format` from `IMAGE_QUALITY_PRESETS`, keyed by preset name or by endpoint."""
+    presets = current_app.config['IMAGE_QUALITY_PRESETS']
+    options = presets.get(preset or request.endpoint) or presets['default']
+    return options.get(format, presets['default'][format])
+
+
+def save_image(im, output, format, quality):
+    if format == 'webp':
+        # the WebP encoder only takes RGB and RGBA
+        if im.mode not in ('RGB', 'RGBA'):
+            has_alpha = im.mode in ('LA', 'La', 'PA', 'RGBa') or 'transparency' in im.info
+            im = im.convert('RGBA' if has_alpha else 'RGB')
+        im.save(output, 'webp', quality=quality, method=4)
+        return
+
+    if im.mode not in ('RGB', 'L', 'CMYK'):
+        im = im.convert('RGB')
+    im.save(output, 'jpeg', quality=quality, optimize=True, progressive=True)
+
+
+def send_image(im, *args, preset=None, **kwargs):
+    format = negotiate_format()
+
     output = BytesIO()
-    im.save(output, 'jpeg')
+    save_image(im, output, format, image_quality(format, preset))
 
     output.seek(0)
 
-    kwargs['mimetype'] = 'image/jpeg'
-    return send_file(output, *args, **kwargs)
+    kwargs['mimetype'] = MIMETYPES[format]
+    response = send_file(output, *args, **kwargs)
+    response.vary.add('Accept')
+    return response
+
+
+def derivative_key(image, size=None, format='jpeg', quality=None):
+    """Identify a rendering of `image` by source contents, crop box, target size and output settings."""
+    file = image.file
+    source = file.digest or 'file:{}:{}'.format(file.id, file.modified_at)
+    crop = (image.top_left_x, image.top_left_y, image.bottom_right_x, image.bottom_right_y)
+    value = '{}|{}|{}|{}|{}'.format(
+        source, ','.join(repr(float(x)) for x in crop), size and '{}x{}'.format(*size), format, quality)
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+def _cache_headers(response, key):
+    response.set_etag(key)
+    # the same URL renders differently depending on what the client accepts
+    response.vary.add('Accept')
+    # derivatives of user uploads, keep them out of shared caches
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['IMAGE_CACHE_MAX_AGE']
+    return response
+
+
+def send_image_derivative(image, size=None, preset=None, **kwargs):
+    """Serve `image` cropped and fitted to `size`, going through the derivative cache.
+
+    The output format is negotiated per request and is part of the cache key, as is the quality.
+    The ETag is derived from the source digest and rendering parameters, so a client revalidating
+    gets its 304 before anything is decoded, and repeat renders come straight from disk.
+    """
+    # imported here, app.utils.file imports this module
+    from app.utils.file import FileQuarantinedException
+    if image.file.quarantined:
+        raise FileQuarantinedException('File is still being scanned for viruses, please try again later.')
+
+    format = negotiate_format()
+    quality = image_quality(format, preset)
+    key = derivative_key(image, size, format, quality)
+
+    if key in request.if_none_match:
+        return _cache_headers(Response(status=304), key)
+
+    path = image_cache.get(key) or _prerendered(image.file, key)
+    if path is None:
+        im = open_image(image, size)
+        if size:
+            im = fit_image(im, size)
+
+        output = BytesIO()
+        save_image(im, output, format, quality)
+        path = image_cache.put(key, output.getvalue())
+
+    kwargs['mimetype'] = MIMETYPES[format]
+    kwargs['add_etags'] = False
+    kwargs.setdefault('cache_timeout', current_app.config['IMAGE_CACHE_MAX_AGE'])
+    response = _cache_headers(send_file(path, **kwargs), key)
+    return response.make_conditional(request)
+
+
+def send_preset_image(file, preset, **kwargs):
+    """Serve a whole `File` at one of the `IMAGE_DERIVATIVE_PRESETS` sizes, pre-rendered when possible."""
+    size = tuple(current_app.config['IMAGE_DERIVATIVE_PRESETS'][preset])
+    return send_image_derivative(FullImage(file), size, preset=preset, **kwargs)
+
+
+def _prerendered(file, key):
+    digest = (file.properties or {}).get('derivatives', {}).get(key)
+    if not digest:
+        return None
+
+    path = blob_store.path(digest)
+    if path is None:
+        # remote backend, keep a local copy to sendfile from
+        with blob_store.open(digest) as f:
+            path = image_cache.put(key, f.read())
+    return path
+
+
+def render_derivatives(file):
+    """Render `file` at every `IMAGE_DERIVATIVE_PRESETS` size in every `IMAGE_DERIVATIVE_FORMATS` format.
+
+    The renders go into the blob store; returns `{derivative key: digest}`, the keys matching what
+    `send_preset_image()` looks up.
+    """
+    image = FullImage(file)
+    formats = [x for x in current_app.config['IMAGE_DERIVATIVE_FORMATS'] if x != 'webp' or _webp_supported()]
+
+    derivatives = {}
+    for preset, size in sorted(current_app.config['IMAGE_DERIVATIVE_PRESETS'].items()):
+        size = tuple(size)
+        # decoded once per size, the draft scale depends on it
+        im = fit_image(open_image(image, size), size)
+
+        for format in formats:
+            quality = image_quality(format, preset)
+            output = BytesIO()
+            save_image(im, output, format, quality)
+            output.seek(0)
+
+            digest, _ = blob_store.put(output)
+            derivatives[derivative_key(image, size, format, quality)] = digest
+
+    return derivatives
@@ -3,6 +3,13 @@
 import base64
 import struct
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAX_32 = 0xffffffff
+
 
 class OpaqueEncoder(object):
     """
@@ -12,25 +19,72 @@ class OpaqueEncoder(object):
     string representations. Expects a secret integer key in the constructor.
     (c) 2011 Marek Z. @marekweb (MIT LICENSE)
     https://github.com/marekweb/opaque-id
+
+    The 16-bit round function is precomputed into a lookup table, IDs above 32 bits are
+    transcoded by a second Feistel layer built on the 32-bit one, and `encode_many` /
+    `decode_many` handle whole batches (vectorized when NumPy is installed).
     """
 
     def __init__(self, key):
         self.key = key
         self.extra_chars = '.-'
+        self._table = [self._transform(i) for i in range(0x10000)]
+        self._array_table = None
 
-    def transform(self, i):
-        """Produce an integer hash of a 16-bit integer, returning a transformed 16-bit integer."""
+    def _transform(self, i):
         i = (self.key ^ i) * 0x9e3b
         return i >> (i & 0xf) & 0xffff
 
+    def transform(self, i):
+        """Produce an integer hash of a 16-bit integer, returning a transformed 16-bit integer."""
+        return self._table[i]
+
     def transcode(self, i):
         """Reversibly transcode a 32-bit integer to a scrambled form, returning a new 32-bit integer."""
+        t = self._table
         r = i & 0xffff
-        l = i >> 16 & 0xffff ^ self.transform(r)
-        return ((r ^ self.transform(l)) << 16) + l
+        l = i >> 16 & 0xffff ^ t[r]  # noqa: E741
+        return ((r ^ t[l]) << 16) + l
+
+    def transcode64(self, i):
+        """Reversibly transcode a 64-bit integer to a scrambled form, returning a new 64-bit integer."""
+        r = i & MAX_32
+        l = i >> 32 & MAX_32 ^ self.transcode(r)  # noqa: E741
+        return ((r ^ self.transcode(l)) << 32) + l
+
+    def transcode_many(self, ids):
+        """Transcode a list or NumPy array of IDs, 64-bit IDs included.
+
+        Arrays are transcoded in one vectorized pass and returned as a `uint64` array,
+        anything else is returned as a list.
+        """
+        if np is not None and isinstance(ids, np.ndarray):
+            return self._transcode_array(ids.astype(np.uint64))
+        return [self.transcode64(i) if i > MAX_32 else self.transcode(i) for i in ids]
+
+    def _transcode_array_32(self, a):
+        if self._array_table is None:
+            self._array_table = np.array(self._table, dtype=np.uint64)
+
+        t = self._array_table
+        r = a & np.uint64(0xffff)
+        l = (a >> np.uint64(16) & np.uint64(0xffff)) ^ t[r]  # noqa: E741
+        return ((r ^ t[l]) << np.uint64(16)) + l
+
+    def _transcode_array(self, a, wide=None):
+        if wide is None:
+            wide = a > np.uint64(MAX_32)
+        rv = self._transcode_array_32(a & np.uint64(MAX_32))
+        if wide.any():
+            r = a[wide] & np.uint64(MAX_32)
+            l = (a[wide] >> np.uint64(32) & np.uint64(MAX_32)) ^ self._transcode_array_32(r)  # noqa: E741
+            rv[wide] = ((r ^ self._transcode_array_32(l)) << np.uint64(32)) + l
+        return rv
 
     def encode_hex(self, i):
-        """Transcode an integer and return it as an 8-character hex string."""
+        """Transcode an integer and return it as an 8-character (16 above 32 bits) hex string."""
+        if i > MAX_32:
+            return "%016x" % self.transcode64(i)
         return "%08x" % self.transcode(i)
 
     def encode_base64(self, i):
@@ -38,13 +92,51 @@ class OpaqueEncoder(object):
         return base64.b64encode(struct.pack('!L', self.transcode(i)), self.extra_chars)[:6]
 
     def decode_hex(self, s):
-        """Decode an 8-character hex string, returning the original integer."""
+        """Decode an 8 or 16-character hex string, returning the original integer."""
+        if len(s) == 16:
+            return self._checked64(self.transcode64(int(s, 16)))
         return self.transcode(int(s, 16))
 
     def decode_base64(self, s):
         """Decode a 6-character base64 string, returning the original integer."""
         return self.transcode(struct.unpack('!L', base64.b64decode(s + '==', self.extra_chars))[0])
 
+    def encode_many(self, ids):
+        """Encode a list or NumPy array of IDs, returning a list of hex strings."""
+        ids = ids.tolist() if np is not None and isinstance(ids, np.ndarray) else list(ids)
+        if np is not None and ids:
+            values = self._transcode_array(np.array(ids, dtype=np.uint64)).tolist()
+        else:
+            values = self.transcode_many(ids)
+        return ["%016x" % v if i > MAX_32 else "%08x" % v for i, v in zip(ids, values)]
+
+    def decode_many(self, values):
+        """Decode a list or NumPy array of hex strings.
+
+        Returns a `uint64` array when given an array and NumPy is installed, a list otherwise.
+        """
+        as_array = np is not None and isinstance(values, np.ndarray)
+        values = values.tolist() if as_array else list(values)
+        wide = [len(s) == 16 for s in values]
+        scrambled = [int(s, 16) for s in values]
+
+        if np is not None and scrambled:
+            # the width of the string, not the scrambled value, says which layer produced it
+            mask = np.array(wide, dtype=bool)
+            ids = self._transcode_array(np.array(scrambled, dtype=np.uint64), wide=mask)
+            if (ids[mask] <= np.uint64(MAX_32)).any():
+                self._checked64(int(ids[mask].min()))
+            return ids if as_array else ids.tolist()
+
+        return [self._checked64(self.transcode64(x)) if w else self.transcode(x) for x, w in zip(scrambled, wide)]
+
+    @staticmethod
+    def _checked64(i):
+        if i <= MAX_32:
+            # every 32-bit id has exactly one 8-character form
+            raise ValueError('non-canonical 64-bit id: {}'.format(i))
+        return i
+
 
 encoder = OpaqueEncoder(0xaf8d97b3)
 
@@ -55,3 +147,11 @@ def encode_id(id):
 
 def decode_id(value):
     return encoder.decode_hex(value)
+
+
+def encode_ids(ids):
+    return encoder.encode_many(ids)
+
+
+def decode_ids(values):
+    return encoder.decode_many(values)
@@ -1,5 +1,7 @@
 # coding: utf-8
 
-from app.utils.sqlalchemy_json.alchemy import JsonObject, NestedJsonObject, NestedMutable
+from app.utils.sqlalchemy_json.alchemy import (GeneratedType, json_path, json_property_expression, JsonObject,
+                                               NestedJsonObject, NestedMutable)
 
-__all__ = ('NestedJsonObject', 'NestedMutable', 'JsonObject')
+__all__ = ('GeneratedType', 'json_path', 'json_property_expression', 'NestedJsonObject', 'NestedMutable',
+           'JsonObject')
@@ -1,6 +1,7 @@
 # coding: utf-8
 
 import ast
+import weakref
 # Third-party modules
 try:
     import simplejson as json
@@ -8,11 +9,15 @@ except ImportError:
     import json
 
 import sqlalchemy
+from sqlalchemy import and_, event, func, inspect, literal
+from sqlalchemy.dialects import mysql
 from sqlalchemy.dialects.mysql import LONGTEXT
 from sqlalchemy.ext import mutable
+from sqlalchemy.orm import Mapper, Session
+from sqlalchemy.orm.attributes import set_committed_value
 
 # Custom modules
-from app.utils.sqlalchemy_json import track
+from app.utils.sqlalchemy_json import codec, track
 
 
 class NestedMutable(mutable.MutableDict, track.TrackedDict):
@@ -20,7 +25,45 @@ class NestedMutable(mutable.MutableDict, track.TrackedDict):
 
     def __setitem__(self, key, value):
         """Ensure that items set are converted to change-tracking types."""
-        super(NestedMutable, self).__setitem__(key, self.convert(value, self))
+        self.mark_changed((key, ))
+        super(NestedMutable, self).__setitem__(key, self.convert(value, self, key))
+
+    def changed(self, message=None, *args):
+        """Flags the owning attributes as modified, unless inside `batch()`."""
+        if self._batched():
+            return
+        super(NestedMutable, self).changed()
+
+    # MutableDict comes first in the MRO, so these would otherwise hand out unconverted values and
+    # skip recording the changed paths
+
+    def __delitem__(self, key):
+        self.mark_changed((key, ))
+        super(NestedMutable, self).__delitem__(key)
+
+    def clear(self):
+        self.mark_changed()
+        super(NestedMutable, self).clear()
+
+    def update(self, source=(), **kwds):
+        source = dict(source, **kwds)
+        for key in source:
+            self.mark_changed((key, ))
+        super(NestedMutable, self).update({key: self.convert(value, self, key) for key, value in source.items()})
+
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return self[key]
+
+    def pop(self, *key_and_default):
+        self.mark_changed(key_and_default[:1])
+        return self.convert(super(NestedMutable, self).pop(*key_and_default), self, key_and_default[0])
+
+    def popitem(self):
+        key, value = super(NestedMutable, self).popitem()
+        self.mark_changed((key, ))
+        return key, self.convert(value, self, key)
 
     @classmethod
     def coerce(cls, key, value):
@@ -28,7 +71,10 @@ class NestedMutable(mutable.MutableDict, track.TrackedDict):
         if isinstance(value, str):
             if value == '':
                 return None
-            else:
+            try:
+                value = codec.loads(value)
+            except ValueError:
+                # python literals, as some older code assigned
                 value = ast.literal_eval(value.strip())
 
         if isinstance(value, cls):
@@ -42,11 +88,15 @@ class _JsonTypeDecorator(sqlalchemy.TypeDecorator):
     """Enables JSON storage by encoding and decoding on the fly."""
     impl = LONGTEXT
 
+    codec = codec.JsonCodec(codec.DEFAULT_COMPRESS_THRESHOLD)
+
     def process_bind_param(self, value, dialect):
-        return json.dumps(value)
+        return self.codec.dumps(value)
 
     def process_result_value(self, value, dialect):
-        return json.loads(value)
+        if value is None:
+            return None
+        return self.codec.loads(value)
 
 
 class JsonObject(_JsonTypeDecorator):
@@ -54,8 +104,207 @@ class JsonObject(_JsonTypeDecorator):
 
 
 class NestedJsonObject(_JsonTypeDecorator):
-    """JSON object type for SQLAlchemy with nested change tracking."""
+    """JSON object type for SQLAlchemy with nested change tracking.
+
+    With `native` the column is a MySQL `JSON` column instead of LONGTEXT, so the server validates
+    and can index into the documents, see `GeneratedType`.
+
+    With `partial_updates`, which needs `native`, an in-place change to a loaded document is written
+    with `JSON_SET` and `JSON_REMOVE` on just the changed paths (MySQL only), falling back to
+    rewriting the whole document when the changes are too broad to describe that way.  On LONGTEXT
+    MySQL would rewrite the whole value anyway, as raw utf8 the connection charset can't hold.
+
+    `compress=False` keeps LONGTEXT documents plain JSON, for queries that read into them on the
+    server; native documents are never compressed.
+    """
+
+    def __init__(self, *args, partial_updates=False, native=False, compress=True, **kwargs):
+        if partial_updates and not native:
+            raise ValueError('partial updates need a native JSON column')
+
+        self.partial_updates = partial_updates
+        self.native = native
+        if native or not compress:
+            self.codec = codec.JsonCodec()
+        super(NestedJsonObject, self).__init__(*args, **kwargs)
+
+    def load_dialect_impl(self, dialect):
+        if self.native:
+            return dialect.type_descriptor(mysql.JSON())
+        return super(NestedJsonObject, self).load_dialect_impl(dialect)
+
+    def process_bind_param(self, value, dialect):
+        if self.native:
+            # the JSON type serializes on its own
+            return value
+        return super(NestedJsonObject, self).process_bind_param(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        if self.native:
+            return value
+        return super(NestedJsonObject, self).process_result_value(value, dialect)
+
+
+class GeneratedType(sqlalchemy.types.UserDefinedType):
+    """A MySQL generated column of `column_type` computed from `expression`.
+
+    The database fills the column in, so it must never be written; it is mostly useful for indexing
+    values inside JSON documents, see `json_property_expression()`.
+    """
+
+    def __init__(self, column_type, expression, stored=False):
+        self.column_type = sqlalchemy.types.to_instance(column_type)
+        self.expression = expression
+        self.stored = stored
+
+    def get_col_spec(self, **kw):
+        return '{} GENERATED ALWAYS AS ({}) {}'.format(
+            self.column_type.compile(dialect=mysql.dialect()), self.expression, 'STORED' if self.stored else 'VIRTUAL')
+
+    def bind_processor(self, dialect):
+        return self.column_type.dialect_impl(dialect).bind_processor(dialect)
+
+    def result_processor(self, dialect, coltype):
+        return self.column_type.dialect_impl(dialect).result_processor(dialect, coltype)
+
+    @property
+    def python_type(self):
+        return self.column_type.python_type
 
 
 mutable.MutableDict.associate_with(JsonObject)
 NestedMutable.associate_with(NestedJsonObject)
+
+_partial_columns_cache = {}
+
+
+def _partial_columns(mapper):
+    """The `(attribute key, column)` pairs of `mapper` stored with partial updates."""
+    columns = _partial_columns_cache.get(mapper)
+    if columns is None:
+        columns = _partial_columns_cache[mapper] = [
+            (prop.key, prop.columns[0]) for prop in mapper.column_attrs
+            if isinstance(prop.columns[0].type, NestedJsonObject) and prop.columns[0].type.partial_updates]
+    return columns
+
+
+def _mark_persisted(obj, key, value):
+    """Remember that `value` is what's stored for `obj.key`, with nothing changed since."""
+    if isinstance(value, NestedMutable):
+        value.persisted = (weakref.ref(obj), key)
+        value.changed_paths = None
+
+
+def _is_persisted(obj, key, value):
+    persisted = value.__dict__.get('persisted')
+    return persisted is not None and persisted[0]() is obj and persisted[1] == key
+
+
+# registered per mapper once configured, so these run after mutable's own load handler has
+# coerced the loaded dict
+
+
+@event.listens_for(Mapper, 'mapper_configured')
+def _listen_for_loads(mapper, class_):
+    if not _partial_columns(mapper):
+        return
+
+    def load(state, *args):
+        for key, column in _partial_columns(mapper):
+            _mark_persisted(state.obj(), key, state.dict.get(key))
+
+    event.listen(class_, 'load', load, raw=True)
+    event.listen(class_, 'refresh', load, raw=True)
+
+
+def json_path(path):
+    """MySQL JSON path for a tuple of keys or a dotted string, e.g. `'a.b'` is `$."a"."b"`."""
+    if isinstance(path, str):
+        path = path.split('.')
+    return '$' + ''.join('.' + json.dumps(key) for key in path)
+
+
+def json_property_expression(column, path):
+    """SQL text for the unquoted value at `path` in the JSON `column`, for generated columns."""
+    return "JSON_UNQUOTE(JSON_EXTRACT(`{}`, '{}'))".format(column, json_path(path).replace("'", "''"))
+
+
+def _lookup(document, path):
+    for key in path:
+        if not isinstance(document, dict) or key not in document:
+            raise KeyError(key)
+        document = dict.__getitem__(document, key)
+    return document
+
+
+def _partial_update(column, document, paths):
+    """`JSON_SET`/`JSON_REMOVE` expression that brings the stored `column` up to `document`."""
+    sets, removes = [], []
+    for path in sorted(paths):
+        try:
+            value = _lookup(document, path)
+        except KeyError:
+            removes.append(json_path(path))
+        else:
+            # JSON_EXTRACT(..., '$') turns the serialized text into a JSON value
+            sets.extend([json_path(path), func.json_extract(literal(codec.dumps(value)), '$')])
+
+    expression = column
+    if sets:
+        expression = func.json_set(expression, *sets)
+    if removes:
+        expression = func.json_remove(expression, *removes)
+    return expression
+
+
+@event.listens_for(Session, 'before_flush')
+def _flush_partial_updates(session, flush_context, instances):
+    for obj in list(session.dirty):
+        state = inspect(obj)
+        columns = _partial_columns(state.mapper)
+        if not columns or state.key is None:
+            continue
+
+        connection = session.connection(mapper=state.mapper)
+        if connection.dialect.name != 'mysql':
+            continue
+
+        values = {}
+        for key, column in columns:
+            value = state.dict.get(key)
+            if key not in state.committed_state or not isinstance(value, NestedMutable):
+                continue
+
+            paths = value.__dict__.get('changed_paths')
+            if not paths or () in paths or not _is_persisted(obj, key, value):
+                # replaced or changed too broadly, the regular flush rewrites it
+                continue
+
+            values[column] = _partial_update(column, value, paths)
+            set_committed_value(obj, key, value)
+            _mark_persisted(obj, key, value)
+
+        if not values:
+            continue
+
+        table = next(iter(values)).table
+        for column in table.c:
+            # what the ORM would have done for this row, e.g. Timestamp.modified_at
+            if column in values or column.onupdate is None or not column.onupdate.is_callable:
+                continue
+            key = state.mapper.get_property_by_column(column).key
+            if key not in state.committed_state:
+                values[column] = column.onupdate.arg(None)
+                set_committed_value(obj, key, values[column])
+
+        identity = state.mapper.primary_key_from_instance(obj)
+        connection.execute(
+            table.update().where(and_(*[c == v for c, v in zip(state.mapper.primary_key, identity)])).values(values))
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_flushed(session, flush_context):
+    for obj in list(session.new) + list(session.dirty):
+        state = inspect(obj)
+        for key, column in _partial_columns(state.mapper):
+            _mark_persisted(obj, key, state.dict.get(key))
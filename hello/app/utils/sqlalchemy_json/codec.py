@@ -0,0 +1,79 @@
+# coding: utf-8
+"""Serialization of JSON column values.
+
+Documents are written as compact JSON.  A `JsonCodec` with a compression
+threshold writes larger documents as the marker `z` followed by their zlib
+stream in base85, which keeps the column plain text.  Reads accept both, and
+anything written before, since a JSON document can never start with `z`.
+"""
+
+# Standard modules
+import base64
+import zlib
+
+# Third-party modules
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    # escapes non-ASCII like json does, the database charset is 3 byte utf8
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+COMPRESSED_MARKER = 'z'
+DEFAULT_COMPRESS_THRESHOLD = 2048
+
+_separators = (',', ':')
+
+
+def _json_dumps(value):
+    return json.dumps(value, separators=_separators)
+
+
+if rapidjson is not None:
+
+    def dumps(value):
+        """Serialize `value` to compact JSON."""
+        try:
+            return rapidjson.dumps(value)
+        except (TypeError, ValueError):
+            # non-string keys, NaN, Decimal... which json handles
+            return _json_dumps(value)
+
+    def loads(text):
+        """Parse JSON text."""
+        try:
+            return rapidjson.loads(text)
+        except ValueError:
+            return json.loads(text)
+
+else:
+    dumps = _json_dumps
+    loads = json.loads
+
+
+class JsonCodec(object):
+    """Encodes column values, compressing documents longer than `compress_threshold` characters."""
+
+    def __init__(self, compress_threshold=None, compress_level=6):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, value):
+        text = dumps(value)
+        if self.compress_threshold is None or len(text) <= self.compress_threshold:
+            return text
+
+        packed = COMPRESSED_MARKER + base64.b85encode(
+            zlib.compress(text.encode('utf-8'), self.compress_level)).decode('ascii')
+        return packed if len(packed) < len(text) else text
+
+    def loads(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        if text.startswith(COMPRESSED_MARKER):
+            text = zlib.decompress(base64.b85decode(text[1:])).decode('utf-8')
+        return loads(text)
@@ -3,14 +3,36 @@
 TrackedObject forms the basis for both the TrackedDict and the TrackedList.
 A function for automatic conversion of dicts and lists to their tracked
 counterparts is also included.
+
+Nested containers are converted lazily: a tracked object keeps the plain
+dicts and lists it was built from and only swaps one for its tracked
+counterpart when it is read back out, so loading a large document costs a
+shallow copy instead of a walk over the whole tree.
+
+Every mutation also records the key path it touched on the root object, in
+`changed_paths`, so that a flush can update just those parts of a stored
+document.  Anything inside a list is recorded as a change of the list itself,
+since positions shift when a list changes.
 """
 
 # Standard modules
-import itertools
+from contextlib import contextmanager
 import logging
 
 logger = logging.getLogger(__name__)
 
+# past this many changed paths the whole document is considered changed
+MAX_CHANGED_PATHS = 32
+
+
+def untracked(value):
+    """A plain copy of `value` with all tracked containers in it replaced by dicts and lists."""
+    if isinstance(value, dict):
+        return {key: untracked(x) for key, x in dict.items(value)}
+    if isinstance(value, list):
+        return [untracked(x) for x in list.__iter__(value)]
+    return value
+
 
 class TrackedObject(object):
     """A base class for delegated change-tracking."""
@@ -18,6 +40,7 @@ class TrackedObject(object):
 
     def __init__(self, *args, **kwds):
         self.parent = None
+        self.key = None
         super(TrackedObject, self).__init__(*args, **kwds)
 
     def changed(self, message=None, *args):
@@ -25,13 +48,74 @@ class TrackedObject(object):
     If a `parent` attribute is set, the `changed()` method on the parent will
     be called, propagating the change notification up the chain.
     The message (if provided) will be debug logged.
+    Inside `batch()` the notification is held back until the batch ends.
     """
-        if message is not None:
-            logger.debug('%s: %s', self._repr(), message % args)
-        logger.debug('%s: changed', self._repr())
+        if logger.isEnabledFor(logging.DEBUG):
+            if message is not None:
+                logger.debug('%s: %s', self._repr(), message % args)
+            logger.debug('%s: changed', self._repr())
+        if self._batched():
+            return
         if self.parent is not None:
             self.parent.changed()
 
+    @contextmanager
+    def batch(self):
+        """Defers change notifications from this object and everything below it.
+
+    Mutations inside the block only go as far up as this object, and a
+    single `changed()` is sent on exit if anything changed.  Changed paths
+    are still recorded as usual.
+    """
+        self._batch_depth = self.__dict__.get('_batch_depth', 0) + 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self.__dict__.pop('_batch_changed', False):
+                self.changed()
+
+    def _batched(self):
+        if self.__dict__.get('_batch_depth'):
+            self._batch_changed = True
+            return True
+        return False
+
+    def mark_changed(self, path=()):
+        """Records on the root that the value at `path` below this object changed."""
+        node = self
+        path = tuple(path)
+        while node.parent is not None:
+            path = () if isinstance(node.parent, list) else (node.key, ) + path
+            node = node.parent
+        node._record_changed_path(path)
+
+    def _record_changed_path(self, path):
+        paths = self.__dict__.get('changed_paths')
+        if paths is None:
+            paths = self.changed_paths = set()
+
+        if any(not isinstance(key, str) for key in path):
+            # only string keys survive a round trip through JSON unchanged
+            path = ()
+
+        if () in paths or any(path[:i] in paths for i in range(1, len(path) + 1)):
+            return
+
+        for other in [x for x in paths if x[:len(path)] == path]:
+            paths.discard(other)
+        paths.add(path)
+
+        if len(paths) > MAX_CHANGED_PATHS:
+            paths.clear()
+            paths.add(())
+
+    def _root(self):
+        node = self
+        while node.parent is not None:
+            node = node.parent
+        return node
+
     @classmethod
     def register(cls, origin_type):
         """Registers the class decorated with this method as a mutation tracker.
@@ -48,21 +132,35 @@ class TrackedObject(object):
         return decorator
 
     @classmethod
-    def convert(cls, obj, parent):
+    def convert(cls, obj, parent, key=None):
         """Converts objects to registered tracked types
     This checks the type of the given object against the registered tracked
     types. When a match is found, the given object will be converted to the
     tracked type, its parent set to the provided parent, and returned.
+    An already tracked object is moved under the provided parent, or copied
+    there if it is still in place elsewhere, since the stored document will
+    hold two separate values.
     If its type does not occur in the registered types mapping, the object
     is returned unchanged.
     """
-        obj_type = type(obj)
-        for origin_type, replacement in cls._type_mapping.items():
-            if obj_type is origin_type:
-                new = replacement(obj)
-                new.parent = parent
-                return new
-        return obj
+        replacement = cls._type_mapping.get(type(obj))
+        if replacement is None:
+            if isinstance(obj, TrackedObject) and parent is not None:
+                if obj.parent is not None and (obj.parent is not parent or obj.key != key) and obj._attached():
+                    return cls.convert(untracked(obj), parent, key)
+                obj.parent = parent
+                obj.key = key
+            return obj
+        new = replacement(obj)
+        new.parent = parent
+        new.key = key
+        return new
+
+    def _attached(self):
+        """Whether the parent still holds this object."""
+        if isinstance(self.parent, dict):
+            return dict.get(self.parent, self.key) is self
+        return any(x is self for x in list.__iter__(self.parent))
 
     @classmethod
     def convert_iterable(cls, iterable, parent):
@@ -72,7 +170,7 @@ class TrackedObject(object):
     @classmethod
     def convert_iteritems(cls, iteritems, parent):
         """Returns a generator like `convert_iterable` for 2-tuple iterators."""
-        return ((key, cls.convert(value, parent)) for key, value in iteritems)
+        return ((key, cls.convert(value, parent, key)) for key, value in iteritems)
 
     @classmethod
     def convert_mapping(cls, mapping, parent):
@@ -95,33 +193,82 @@ class TrackedDict(TrackedObject, dict):
     """A TrackedObject implementation of the basic dictionary."""
 
     def __init__(self, source=(), **kwds):
-        super(TrackedDict,
-              self).__init__(itertools.chain(self.convert_mapping(source, self), self.convert_mapping(kwds, self)))
+        super(TrackedDict, self).__init__(source, **kwds)
+
+    def _track(self, key, value):
+        """Swaps a stored plain container for its tracked counterpart."""
+        if type(value) in self._type_mapping:
+            value = self.convert(value, self, key)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def _track_all(self):
+        for key, value in dict.items(self):
+            if type(value) in self._type_mapping:
+                self._track(key, value)
+
+    def __getitem__(self, key):
+        return self._track(key, super(TrackedDict, self).__getitem__(key))
+
+    def __iter__(self):
+        # overriding it stops dict(d) and {**d} from copying the stored values directly, they go
+        # through keys() and __getitem__() instead
+        return super(TrackedDict, self).__iter__()
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        self._track_all()
+        return super(TrackedDict, self).items()
+
+    def values(self):
+        self._track_all()
+        return super(TrackedDict, self).values()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def copy(self):
+        self._track_all()
+        return super(TrackedDict, self).copy()
 
     def __setitem__(self, key, value):
+        self.mark_changed((key, ))
         self.changed('__setitem__: %r=%r', key, value)
-        super(TrackedDict, self).__setitem__(key, self.convert(value, self))
+        super(TrackedDict, self).__setitem__(key, self.convert(value, self, key))
 
     def __delitem__(self, key):
+        self.mark_changed((key, ))
         self.changed('__delitem__: %r', key)
         super(TrackedDict, self).__delitem__(key)
 
     def clear(self):
+        self.mark_changed()
         self.changed('clear')
         super(TrackedDict, self).clear()
 
     def pop(self, *key_and_default):
+        self.mark_changed(key_and_default[:1])
         self.changed('pop: %r', key_and_default)
-        return super(TrackedDict, self).pop(*key_and_default)
+        return self.convert(super(TrackedDict, self).pop(*key_and_default), self, key_and_default[0])
 
     def popitem(self):
         self.changed('popitem')
-        return super(TrackedDict, self).popitem()
+        key, value = super(TrackedDict, self).popitem()
+        self.mark_changed((key, ))
+        return key, self.convert(value, self, key)
 
     def update(self, source=(), **kwds):
         self.changed('update(%r, %r)', source, kwds)
-        super(TrackedDict,
-              self).update(itertools.chain(self.convert_mapping(source, self), self.convert_mapping(kwds, self)))
+        source = dict(source, **kwds)
+        for key in source:
+            self.mark_changed((key, ))
+        super(TrackedDict, self).update((key, self.convert(value, self, key)) for key, value in source.items())
 
 
 @TrackedObject.register(list)
@@ -129,32 +276,79 @@ class TrackedList(TrackedObject, list):
     """A TrackedObject implementation of the basic list."""
 
     def __init__(self, iterable=()):
-        super(TrackedList, self).__init__(self.convert_iterable(iterable, self))
+        super(TrackedList, self).__init__(iterable)
+
+    def _track(self, index, value):
+        """Swaps a stored plain container for its tracked counterpart."""
+        if type(value) in self._type_mapping:
+            value = self.convert(value, self)
+            list.__setitem__(self, index, value)
+        return value
+
+    def _track_all(self):
+        for index, value in enumerate(list.__iter__(self)):
+            if type(value) in self._type_mapping:
+                self._track(index, value)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            self._track_all()
+            return super(TrackedList, self).__getitem__(key)
+        return self._track(key, super(TrackedList, self).__getitem__(key))
+
+    def __iter__(self):
+        self._track_all()
+        return super(TrackedList, self).__iter__()
+
+    def __reversed__(self):
+        self._track_all()
+        return super(TrackedList, self).__reversed__()
+
+    def copy(self):
+        self._track_all()
+        return super(TrackedList, self).copy()
+
+    def __add__(self, other):
+        self._track_all()
+        return super(TrackedList, self).__add__(other)
+
+    def __mul__(self, count):
+        self._track_all()
+        return super(TrackedList, self).__mul__(count)
+
+    __rmul__ = __mul__
 
     def __setitem__(self, key, value):
+        self.mark_changed()
         self.changed('__setitem__: %r=%r', key, value)
         super(TrackedList, self).__setitem__(key, self.convert(value, self))
 
     def __delitem__(self, key):
+        self.mark_changed()
         self.changed('__delitem__: %r', key)
         super(TrackedList, self).__delitem__(key)
 
     def append(self, item):
+        self.mark_changed()
         self.changed('append: %r', item)
         super(TrackedList, self).append(self.convert(item, self))
 
     def extend(self, iterable):
+        self.mark_changed()
         self.changed('extend: %r', iterable)
         super(TrackedList, self).extend(self.convert_iterable(iterable, self))
 
     def remove(self, value):
+        self.mark_changed()
         self.changed('remove: %r', value)
         return super(TrackedList, self).remove(value)
 
     def pop(self, index):
+        self.mark_changed()
         self.changed('pop: %d', index)
-        return super(TrackedList, self).pop(index)
+        return self.convert(super(TrackedList, self).pop(index), self)
 
     def sort(self, cmp=None, key=None, reverse=False):
+        self.mark_changed()
         self.changed('sort')
         super(TrackedList, self).sort(cmp=cmp, key=key, reverse=reverse)
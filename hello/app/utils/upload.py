@@ -0,0 +1,253 @@
+# coding: utf-8
+
+from datetime import datetime
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import uuid
+
+from flask import current_app
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import Conflict, NotFound, RequestEntityTooLarge
+
+from app.utils.blob import CHUNK_SIZE
+from app.utils.file import FileExtensionNotAllowedException, is_extension_allowed, upload_file
+
+logger = logging.getLogger(__name__)
+
+_id_re = re.compile('^[0-9a-f]{32}$')
+
+
+class UploadIncompleteException(Conflict):
+    pass
+
+
+class UploadOffsetMismatchException(Conflict):
+    pass
+
+
+class UploadBusyException(Conflict):
+    pass
+
+
+class UploadFinalizedException(Conflict):
+    pass
+
+
+def _root():
+    return current_app.config['UPLOAD_SESSION_PATH'] or os.path.join(current_app.instance_path, 'uploads')
+
+
+class UploadSession(object):
+    """A resumable upload kept on local disk until it is finalized into a `File`.
+
+    Every session is a `<id>.part` file holding the bytes received so far, which is the source of truth
+    for the current offset, next to a `<id>.json` sidecar with the owner, filename, expected length and
+    state.  Chunks are appended under an exclusive lock on the part file, so concurrent requests for the
+    same session can't interleave; a request finding it locked gets a 409 rather than waiting.
+
+    Finalizing reads the whole upload again, so a request only asks for it and the `finalize_upload`
+    task does it, which means `UPLOAD_SESSION_PATH` has to be shared with the celery workers.  The
+    sidecar then records the new `File`, or why the upload was refused, until the session is purged.
+    """
+
+    UPLOADING = 'uploading'
+    FINALIZING = 'finalizing'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, id, meta):
+        self.id = id
+        self.meta = meta
+
+    @property
+    def filename(self):
+        return self.meta['filename']
+
+    @property
+    def length(self):
+        return self.meta['length']
+
+    @property
+    def user_id(self):
+        return self.meta['user_id']
+
+    @property
+    def state(self):
+        return self.meta.get('state', self.UPLOADING)
+
+    @property
+    def part_path(self):
+        return os.path.join(_root(), self.id + '.part')
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.part_path)
+        except FileNotFoundError:
+            raise NotFound('Upload not found.')
+
+    @classmethod
+    def create(cls, user_id, filename, length):
+        if not is_extension_allowed(filename):
+            raise FileExtensionNotAllowedException("Given filename's extension not allowed for upload.")
+        if length > current_app.config['UPLOAD_SESSION_MAX_LENGTH']:
+            raise RequestEntityTooLarge('Upload is too large.')
+
+        root = _root()
+        os.makedirs(root, exist_ok=True)
+
+        session = cls(uuid.uuid4().hex, {
+            'user_id': user_id,
+            'filename': filename,
+            'length': length,
+            'created_at': datetime.utcnow().isoformat(),
+            'state': cls.UPLOADING,
+        })
+
+        open(session.part_path, 'xb').close()
+        session._save_meta()
+
+        return session
+
+    @classmethod
+    def get(cls, id, user_id=None):
+        if not _id_re.match(id):
+            raise NotFound('Upload not found.')
+
+        try:
+            with open(os.path.join(_root(), id + '.json')) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise NotFound('Upload not found.')
+
+        if user_id is not None and meta['user_id'] != user_id:
+            raise NotFound('Upload not found.')
+
+        return cls(id, meta)
+
+    def _save_meta(self):
+        root = _root()
+        with tempfile.NamedTemporaryFile('w', dir=root, delete=False) as f:
+            json.dump(self.meta, f)
+        os.replace(f.name, os.path.join(root, self.id + '.json'))
+
+    def _open_locked(self):
+        try:
+            f = open(self.part_path, 'r+b')
+        except FileNotFoundError:
+            raise NotFound('Upload not found.')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # a duplicate or retried request, don't tie up another worker waiting for it
+            f.close()
+            raise UploadBusyException('Upload is busy with another request.')
+        return f
+
+    def append(self, stream, offset, chunk_size=CHUNK_SIZE):
+        """Append everything read from `stream` at `offset`, returning the new offset.
+
+        Whatever arrives before a dropped connection is kept, so the client can resume from there.
+        """
+        if self.state != self.UPLOADING:
+            raise UploadFinalizedException('Upload is already finalized.')
+
+        with self._open_locked() as f:
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                raise UploadOffsetMismatchException('Upload is at offset {}.'.format(current))
+
+            try:
+                for chunk in iter(lambda: stream.read(chunk_size), b''):
+                    if f.tell() + len(chunk) > self.length:
+                        f.truncate(current)
+                        raise RequestEntityTooLarge('Chunk goes past the declared upload length.')
+                    f.write(chunk)
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+
+            return f.tell()
+
+    def request_finalize(self):
+        """Check that the upload is complete and queue the `finalize_upload` task for it."""
+        if self.state != self.UPLOADING:
+            # asked twice
+            return
+
+        with self._open_locked() as f:
+            size = f.seek(0, os.SEEK_END)
+            if size != self.length:
+                raise UploadIncompleteException('Upload is at offset {} of {}.'.format(size, self.length))
+
+            self.meta = self.get(self.id).meta
+            if self.state != self.UPLOADING:
+                return
+
+            self.meta['state'] = self.FINALIZING
+            self._save_meta()
+
+        from app.tasks import finalize_upload
+        finalize_upload.delay(self.id)
+
+    def finalize(self, scan=True):
+        """Run the `upload_file()` checks over the complete upload and return the new `File`."""
+        with self._open_locked() as f:
+            size = f.seek(0, os.SEEK_END)
+            if size != self.length:
+                raise UploadIncompleteException('Upload is at offset {} of {}.'.format(size, self.length))
+
+            f.seek(0)
+            return upload_file(FileStorage(f, filename=self.filename, content_length=size), scan=scan)
+
+    def finish(self, file_id=None, error=None):
+        """Record the outcome of `finalize()` and drop the uploaded bytes."""
+        self.meta['state'] = self.FAILED if error else self.DONE
+        self.meta['file_id'] = file_id
+        self.meta['error'] = error
+        self._save_meta()
+
+        try:
+            os.unlink(self.part_path)
+        except FileNotFoundError:
+            pass
+
+    def delete(self):
+        root = _root()
+        for path in (os.path.join(root, self.id + '.json'), self.part_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def purge_upload_sessions(max_age=None):
+    """Remove sessions that haven't received anything, or were finalized, `UPLOAD_SESSION_MAX_AGE` seconds ago."""
+    root = _root()
+    if not os.path.isdir(root):
+        return 0
+
+    max_age = max_age or current_app.config['UPLOAD_SESSION_MAX_AGE']
+    cutoff = time.time() - max_age
+
+    purged = 0
+    for entry in os.scandir(root):
+        id, ext = os.path.splitext(entry.name)
+        if ext == '.json' and os.path.exists(os.path.join(root, id + '.part')):
+            # still uploading, the part file says when it was last written to
+            continue
+        if ext not in ('.part', '.json'):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                UploadSession(id, None).delete()
+                purged += 1
+        except FileNotFoundError:
+            pass
+
+    return purged
@@ -32,15 +32,9 @@ class LoginForm(FlaskForm):
             return False
 
         user = User.query.filter_by(email=self.email.data).one_or_none()
-        if user:
-            password_match = User.check_password(user.password, self.password.data)
-            temp_password_match = User.check_password(user.temp_password, self.password.data)
-            if password_match or temp_password_match:
-                if not password_match and temp_password_match:
-                    # these are only good once
-                    user.temp_password = None
-                self.user = user
-                return True
+        if user and user.verify_password(self.password.data):
+            self.user = user
+            return True
 
         self.password.errors.append('Invalid email and/or password specified.')
         return False
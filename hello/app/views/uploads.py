@@ -0,0 +1,105 @@
+# coding: utf-8
+
+import json
+import logging
+
+from flask import Blueprint, g, request, Response, url_for
+from werkzeug.exceptions import BadRequest
+
+from app.extensions.login import login_required
+from app.models import File
+from app.utils.upload import UploadSession
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('uploads', __name__)
+
+
+def _json_response(data, status=200, **headers):
+    return Response(json.dumps(data), status=status, headers=headers, mimetype='application/json')
+
+
+def _offset_headers(session, offset=None):
+    return {
+        'Upload-Offset': str(session.offset if offset is None else offset),
+        'Upload-Length': str(session.length),
+        'Cache-Control': 'no-store',
+    }
+
+
+def _int_header(name):
+    try:
+        value = int(request.headers[name])
+    except (KeyError, ValueError):
+        raise BadRequest('Missing or invalid {} header.'.format(name))
+    if value < 0:
+        raise BadRequest('Invalid {} header.'.format(name))
+    return value
+
+
+@bp.route('/', methods=['POST'])
+@login_required
+def create():
+    """Start an upload of `{"filename": ..., "length": ...}` bytes."""
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename')
+    length = data.get('length')
+    if not filename or not isinstance(length, int) or length < 0:
+        raise BadRequest('filename and length are required.')
+
+    session = UploadSession.create(g.current_user.id, filename, length)
+
+    location = url_for('.status', upload_id=session.id)
+    return _json_response({'id': session.id, 'offset': 0}, 201, Location=location, **_offset_headers(session, 0))
+
+
+def _file_data(file):
+    return {'id': file.id, 'name': file.name, 'size': file.size, 'mimetype': file.mimetype}
+
+
+@bp.route('/<upload_id>', methods=['GET', 'HEAD'])
+@login_required
+def status(upload_id):
+    """Where the upload is at, and once finalized the new file or why it was refused."""
+    session = UploadSession.get(upload_id, g.current_user.id)
+    if session.state == UploadSession.UPLOADING:
+        headers = _offset_headers(session)
+    else:
+        # the bytes have been handed over, or are being
+        headers = _offset_headers(session, session.length)
+
+    data = {'id': session.id, 'offset': int(headers['Upload-Offset']), 'state': session.state}
+    if session.state == UploadSession.DONE:
+        file = File.query.get(session.meta['file_id'])
+        data['file'] = _file_data(file) if file is not None else None
+    elif session.state == UploadSession.FAILED:
+        data['error'] = session.meta['error']
+
+    return _json_response(data, **headers)
+
+
+@bp.route('/<upload_id>', methods=['PATCH'])
+@login_required
+def append(upload_id):
+    """Append the request body at the `Upload-Offset` the client believes the upload is at."""
+    session = UploadSession.get(upload_id, g.current_user.id)
+    offset = session.append(request.stream, _int_header('Upload-Offset'))
+    return Response(status=204, headers=_offset_headers(session, offset))
+
+
+@bp.route('/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize(upload_id):
+    """Queue the checks that turn the complete upload into a file, poll the status URL for the outcome."""
+    session = UploadSession.get(upload_id, g.current_user.id)
+    session.request_finalize()
+
+    location = url_for('.status', upload_id=session.id)
+    return _json_response({'id': session.id, 'state': session.state}, 202, Location=location)
+
+
+@bp.route('/<upload_id>', methods=['DELETE'])
+@login_required
+def delete(upload_id):
+    UploadSession.get(upload_id, g.current_user.id).delete()
+    return Response(status=204)
@@ -0,0 +1,33 @@
+# coding: utf-8
+
+import logging
+
+from flask import Blueprint, g, jsonify, request
+from werkzeug.exceptions import Forbidden, NotFound
+
+from app.extensions.login import login_required
+from app.extensions.user_directory import user_directory
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('users', __name__)
+
+MAX_AUTOCOMPLETE_LIMIT = 50
+
+
+@bp.route('/autocomplete')
+@login_required
+def autocomplete():
+    """Users whose first name, last name, full name or email starts with `q`, from the in-memory directory."""
+    if not user_directory.enabled:
+        raise NotFound()
+    if not g.current_user.is_staff:
+        # it hands out email addresses
+        raise Forbidden()
+
+    limit = min(request.args.get('limit', 10, type=int), MAX_AUTOCOMPLETE_LIMIT)
+    results = user_directory.search(request.args.get('q', ''), limit=max(limit, 1))
+
+    response = jsonify({'results': results})
+    response.headers['Cache-Control'] = 'private, max-age=30'
+    return response
@@ -7,12 +7,14 @@ from logging.config import fileConfig
 
 from alembic import context
 from alembic import op
+from alembic.autogenerate.render import _repr_type
 from flask import current_app
 from sqlalchemy import engine_from_config, pool
 from sqlalchemy.dialects import mysql
 from sqlalchemy.sql.schema import Column
 
 from app.utils.database import db
+from app.utils.sqlalchemy_json import GeneratedType, NestedJsonObject
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -107,12 +109,27 @@ FALLBACK_TO_DEFAULT_BEHAVIOR = None
 
 
 def compare_type(context, inspected_column, metadata_column, inspected_type, metadata_type):
+    if isinstance(metadata_type, NestedJsonObject):
+        # stored as whatever load_dialect_impl() picks
+        return not isinstance(inspected_type, mysql.JSON if metadata_type.native else mysql.LONGTEXT)
+
+    if isinstance(metadata_type, GeneratedType):
+        # generated columns reflect as their plain type
+        return context.impl.compare_type(inspected_column, Column(metadata_column.name, metadata_type.column_type))
+
     return FALLBACK_TO_DEFAULT_BEHAVIOR
 
 
 def render_item(type_, obj, autogen_context):
     """Apply custom rendering for selected items."""
 
+    if type_ == 'type' and isinstance(obj, NestedJsonObject) and obj.native:
+        return 'app.utils.sqlalchemy_json.alchemy.NestedJsonObject(native=True)'
+
+    if type_ == 'type' and isinstance(obj, GeneratedType):
+        return 'app.utils.sqlalchemy_json.alchemy.GeneratedType({}, {!r}, stored={!r})'.format(
+            _repr_type(obj.column_type, autogen_context), obj.expression, obj.stored)
+
     # default rendering for other objects
     return False
 
@@ -0,0 +1,10 @@
+# coding: utf-8
+
+from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlalchemy.ext.compiler import compiles
+
+
+@compiles(LONGTEXT, 'sqlite')
+def _compile_longtext(element, compiler, **kw):
+    # the tests run against sqlite
+    return 'TEXT'
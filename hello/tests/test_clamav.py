@@ -0,0 +1,132 @@
+# coding: utf-8
+
+from io import BytesIO
+import os
+import socket
+import struct
+import tempfile
+import threading
+
+import pytest
+
+from app.extensions.clamav import ClamAV, ClamAVError, ClamAVSizeLimitError
+
+SIGNATURE = b'FAKE-SIGNATURE'
+
+
+class FakeClamd(object):
+    """Just enough of clamd's IDSESSION/INSTREAM protocol, flagging streams that contain `SIGNATURE`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._session, args=(connection, ), daemon=True).start()
+
+    @staticmethod
+    def _read(f, size):
+        data = f.read(size)
+        if len(data) != size:
+            raise EOFError()
+        return data
+
+    def _command(self, f):
+        command = b''
+        while not command.endswith(b'\0'):
+            command += self._read(f, 1)
+        return command[:-1]
+
+    def _session(self, connection):
+        with connection, connection.makefile('rb') as f:
+            try:
+                assert self._command(f) == b'zIDSESSION'
+                id = 0
+                while self._command(f) == b'zINSTREAM':
+                    id += 1
+                    data = b''
+                    while True:
+                        size = struct.unpack('!L', self._read(f, 4))[0]
+                        if not size:
+                            break
+                        data += self._read(f, size)
+
+                    verdict = 'stream: {} FOUND'.format(SIGNATURE.decode()) if SIGNATURE in data else 'stream: OK'
+                    connection.sendall('{}: {}\0'.format(id, verdict).encode())
+            except EOFError:
+                pass
+
+    def close(self):
+        self.sock.close()
+
+
+class FakeApp(object):
+
+    def __init__(self, server):
+        self.config = {
+            'CLAMAV_SERVER': server,
+            'CLAMAV_ASYNC_THRESHOLD': 10 * 1024 * 1024,
+            'CLAMAV_STREAM_MAX_LENGTH': 25 * 1024 * 1024,
+            'CLAMAV_POOL_SIZE': 2,
+            'CLAMAV_TIMEOUT': 5,
+            'CLAMAV_IDLE_TIMEOUT': 25,
+        }
+
+
+@pytest.fixture
+def socket_path():
+    directory = tempfile.mkdtemp()
+    yield os.path.join(directory, 'clamd.sock')
+    try:
+        os.unlink(os.path.join(directory, 'clamd.sock'))
+    except FileNotFoundError:
+        pass
+    os.rmdir(directory)
+
+
+@pytest.fixture
+def clamav(socket_path):
+    server = FakeClamd(socket_path)
+    clamav = ClamAV()
+    clamav.init_app(FakeApp(socket_path))
+    yield clamav
+    server.close()
+
+
+def test_clean(clamav):
+    assert clamav.scan(BytesIO(b'hello world' * 10000), chunk_size=4096) is None
+
+
+def test_infected(clamav):
+    assert clamav.scan(BytesIO(b'hello ' + SIGNATURE + b' world')) == SIGNATURE.decode()
+
+
+def test_session_is_reused(clamav):
+    assert clamav.scan(BytesIO(b'one')) is None
+    assert clamav.scan(BytesIO(SIGNATURE)) == SIGNATURE.decode()
+    assert len(clamav.pool._idle) == 1
+
+
+def test_unavailable(socket_path):
+    clamav = ClamAV()
+    clamav.init_app(FakeApp(socket_path))
+
+    with pytest.raises(ClamAVError):
+        clamav.scan(BytesIO(b'hello world'))
+
+
+def test_longer_than_clamd_takes(clamav):
+    clamav.stream_max_length = 1000
+
+    with pytest.raises(ClamAVSizeLimitError):
+        clamav.scan(BytesIO(b'x' * 1001), chunk_size=100)
+    assert clamav.scan(BytesIO(b'x' * 1000), chunk_size=100) is None
@@ -0,0 +1,117 @@
+# coding: utf-8
+
+from decimal import Decimal
+
+from flask import Flask
+import pytest
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import mysql
+
+from app.models import User
+from app.utils.database import (db, decode_seek_token, encode_seek_token, fold_text, InvalidSeekTokenException,
+                                trigram_table, trigrams)
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+
+    with app.app_context():
+        db.metadata.create_all(db.engine, tables=[User.__table__, trigram_table])
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def user_id(app):
+    user = User(email='jane@example.com', first_name='Jane', last_name='Doe', properties={'theme': 'dark'})
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    db.session.expunge_all()
+    return user_id
+
+
+@pytest.fixture
+def statements(app, user_id):
+    """Every SELECT run against the database once the user is in."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def test_properties_left_out_of_default_select(app):
+    assert 'user.properties' not in str(User.query)
+    assert 'user.properties' in str(User.query.with_properties())
+
+
+def test_properties_loaded_on_first_access(user_id, statements):
+    user = User.query.get(user_id)
+    assert 'properties' in inspect(user).unloaded
+    assert len(statements) == 1
+
+    assert user.properties == {'theme': 'dark'}
+    assert 'properties' not in inspect(user).unloaded
+    assert len(statements) == 2
+    assert 'properties' in statements[1]
+
+    # loaded now, reading it again doesn't query
+    assert user.properties['theme'] == 'dark'
+    assert len(statements) == 2
+
+
+def test_with_properties_loads_them_along(user_id, statements):
+    user = User.query.with_properties().get(user_id)
+    assert 'properties' not in inspect(user).unloaded
+
+    assert user.properties == {'theme': 'dark'}
+    assert len(statements) == 1
+
+
+def test_seek_token_keeps_search_scores_exact():
+    token = encode_seek_token([Decimal('0.333333333333'), 42])
+    assert decode_seek_token(token) == [Decimal('0.333333333333'), 42]
+
+
+def test_ranked_search_pages_on_the_rounded_score(app):
+    query = User.query.ranked_search('jo', User, after=(Decimal('0.5'), 42))
+    sql = str(query.statement.compile(dialect=mysql.dialect()))
+
+    score = 'CAST(MATCH (`user`.first_name, `user`.last_name) AGAINST (%s IN BOOLEAN MODE) AS DECIMAL(30, 12))'
+    assert sql.count(score) == 4  # selected, compared twice and ordered by
+    assert 'ORDER BY {} DESC'.format(score) in sql
+
+
+def test_search_page_refuses_other_tokens(app):
+    with pytest.raises(InvalidSeekTokenException):
+        User.query.search_page('jo', User, after=encode_seek_token(['x', 1, 2]))
+
+
+@pytest.mark.parametrize('text, row', [
+    ('straße', 'STRASE'),  # ß = s, not ss
+    ('Ångström', 'angstrom'),
+    ('ıi', 'Iİ'),
+    ('ΟΔΟΣ', 'οδος'),  # final sigma
+    ('ſ', 's'),
+])
+def test_trigrams_fold_what_the_collation_equates(text, row):
+    assert fold_text(text) == fold_text(row)
+    assert trigrams(text) <= trigrams('x' + row + 'x')
+
+
+def test_indexed_row_is_a_candidate_for_what_the_collation_would_match(app):
+    db.session.add(User(email='jane@example.com', first_name='Jane', last_name='Strase'))
+    db.session.commit()
+
+    # sqlite's LIKE doesn't equate ß and s, MySQL's does once the index lets the row through
+    indexed = {x for x, in db.session.query(trigram_table.c.trigram).filter(trigram_table.c.owner == 'user.last_name')}
+    assert trigrams('traße') <= indexed
@@ -0,0 +1,131 @@
+# coding: utf-8
+
+from io import BytesIO
+import os
+import shutil
+import tempfile
+
+from flask import Flask
+from PIL import Image
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from app.extensions.blob_store import blob_store
+from app.extensions.clamav import clamav
+from app.extensions.flask_celery import celery
+from app.models import File
+from app.utils.file import FileTooLargeToScanException, upload_file
+from app.utils.database import db
+from tests.test_clamav import FakeClamd, SIGNATURE
+
+
+@pytest.fixture
+def app():
+    directory = tempfile.mkdtemp()
+    server = FakeClamd(os.path.join(directory, 'clamd.sock'))
+
+    app = Flask('app', instance_path=directory)
+    app.config.from_object('app.settings')
+    app.config.update({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'db.sqlite'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'CELERY_TASK_ALWAYS_EAGER': True,
+        'CLAMAV_SERVER': server.path,
+    })
+    for extension in (blob_store, celery, clamav, db):
+        extension.init_app(app)
+
+    with app.app_context():
+        db.metadata.create_all(db.engine, tables=[File.__table__])
+        yield app
+        db.session.remove()
+
+    server.close()
+    shutil.rmtree(directory)
+
+
+def _commit(contents, **kwargs):
+    file = File(BytesIO(contents), **kwargs)
+    db.session.add(file)
+    db.session.commit()
+    return file.id
+
+
+def _png():
+    output = BytesIO()
+    Image.new('RGB', (400, 300), 'red').save(output, 'PNG')
+    return output.getvalue()
+
+
+def test_quarantined_file_scanned_on_commit(app):
+    file_id = _commit(b'hello world', name='hello.txt', mimetype='text/plain', quarantined=True)
+
+    db.session.expire_all()
+    assert File.query.get(file_id).quarantined is False
+
+
+def test_infected_file_stays_quarantined(app):
+    file_id = _commit(b'hello ' + SIGNATURE, name='hello.txt', mimetype='text/plain', quarantined=True)
+
+    db.session.expire_all()
+    file = File.query.get(file_id)
+    assert file.quarantined is True
+    assert file.properties['virus'] == SIGNATURE.decode()
+
+
+def test_quarantined_file_scanned_after_the_request(app):
+    with app.test_request_context('/'):
+        file_id = _commit(b'hello world', name='hello.txt', mimetype='text/plain', quarantined=True)
+
+        db.session.expire_all()
+        assert File.query.get(file_id).quarantined is True
+
+        app.process_response(app.response_class())
+
+        db.session.expire_all()
+        assert File.query.get(file_id).quarantined is False
+
+
+def test_image_derivatives_rendered_on_commit(app):
+    file_id = _commit(_png(), name='red.png', mimetype='image/png')
+
+    db.session.expire_all()
+    derivatives = File.query.get(file_id).properties['derivatives']
+    assert len(derivatives) == len(app.config['IMAGE_DERIVATIVE_PRESETS']) * len(app.config['IMAGE_DERIVATIVE_FORMATS'])
+    for digest in derivatives.values():
+        with blob_store.open(digest) as stream:
+            assert Image.open(stream).size[0] <= 800
+
+
+def test_image_derivatives_rendered_once_scanned(app):
+    file_id = _commit(_png(), name='red.png', mimetype='image/png', quarantined=True)
+
+    db.session.expire_all()
+    file = File.query.get(file_id)
+    assert file.quarantined is False
+    assert file.properties['derivatives']
+
+
+def _upload(contents, content_length=None):
+    return upload_file(FileStorage(BytesIO(contents), filename='hello.txt', content_length=content_length))
+
+
+def test_upload_scanned_inline(app):
+    file = _upload(b'hello world', content_length=11)
+    assert file.quarantined is False
+
+
+def test_upload_of_unknown_length_quarantined(app):
+    file = _upload(b'hello world')
+    assert file.quarantined is True
+
+
+def test_upload_longer_than_clamd_takes_refused(app):
+    clamav.stream_max_length = 1000
+
+    with pytest.raises(FileTooLargeToScanException):
+        _upload(b'x' * 1001, content_length=1001)
+
+    # announced or not
+    with pytest.raises(FileTooLargeToScanException):
+        _upload(b'x' * 1001)
@@ -0,0 +1,83 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from app.extensions.image_cache import DerivativeCache, STALE_TEMP_AGE, TEMP_DIRECTORY
+
+
+class FakeApp(object):
+
+    def __init__(self, path, max_size):
+        self.instance_path = path
+        self.config = {'IMAGE_CACHE_PATH': path, 'IMAGE_CACHE_MAX_SIZE': max_size}
+
+
+@pytest.fixture
+def directory():
+    directory = tempfile.mkdtemp()
+    yield directory
+    shutil.rmtree(directory)
+
+
+def _cache(directory, max_size=1000):
+    cache = DerivativeCache()
+    cache.init_app(FakeApp(directory, max_size))
+    return cache
+
+
+def _disk_size(cache):
+    return sum(size for _, _, size in cache._scan())
+
+
+def test_workers_share_the_size_limit(directory):
+    # one instance per worker process
+    workers = [_cache(directory) for _ in range(4)]
+
+    for i in range(40):
+        workers[i % len(workers)].put('{:02x}key{}'.format(i, i), b'x' * 100)
+        assert _disk_size(workers[0]) <= 1000
+
+    assert _disk_size(workers[0]) >= 900
+
+
+def test_least_recently_used_evicted_first(directory):
+    cache = _cache(directory)
+    for i in range(10):
+        cache.put('aa{}'.format(i), b'x' * 100)
+        os.utime(cache.path('aa{}'.format(i)), (i, i))
+
+    cache.get('aa0')
+    cache.put('bb', b'x' * 100)
+
+    assert cache.get('aa0') is not None
+    assert cache.get('aa1') is None
+    assert cache.get('bb') is not None
+
+
+def test_replaced_entry_counted_once(directory):
+    cache = _cache(directory)
+    for _ in range(20):
+        cache.put('aa', b'x' * 100)
+
+    assert cache._read_size() == 100
+
+
+def test_stale_temp_files_removed(directory):
+    cache = _cache(directory)
+    stale = os.path.join(directory, TEMP_DIRECTORY, 'stale')
+    fresh = os.path.join(directory, TEMP_DIRECTORY, 'fresh')
+    for path in (stale, fresh):
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+    os.utime(stale, (time.time() - STALE_TEMP_AGE - 1, ) * 2)
+
+    cache.evict()
+
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+    assert _cache(directory)._read_size() == 0
@@ -0,0 +1,117 @@
+# coding: utf-8
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from flask import Flask, g
+import pytest
+from sqlalchemy import event
+
+from app.extensions.login import _dumps, init_app as login_init_app
+from app.models import User
+from app.utils.database import db, trigram_table
+from app.utils.identity import identity_cache, materialize
+
+PROPERTIES = {'notes': 'x' * 50000}
+
+
+class Fetched(object):
+    """Bytes of the rows read from the database so far."""
+    size = 0
+
+
+def _row_size(row):
+    return sum(len(x) if isinstance(x, (str, bytes)) else 8 for x in row if x is not None)
+
+
+class CountingCursor(sqlite3.Cursor):
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            Fetched.size += _row_size(row)
+        return row
+
+    def fetchmany(self, *args):
+        rows = super().fetchmany(*args)
+        Fetched.size += sum(_row_size(x) for x in rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        Fetched.size += sum(_row_size(x) for x in rows)
+        return rows
+
+
+class CountingConnection(sqlite3.Connection):
+
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+
+@pytest.fixture
+def app():
+    directory = tempfile.mkdtemp()
+
+    app = Flask('app', instance_path=directory)
+    app.config.from_object('app.settings')
+    app.config.update({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'db.sqlite'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SECRET_KEY': 'secret',
+    })
+    db.init_app(app)
+    login_init_app(app)
+
+    with app.app_context():
+
+        @event.listens_for(db.engine, 'do_connect')
+        def do_connect(dialect, connection_record, cargs, cparams):
+            cparams['factory'] = CountingConnection
+
+        db.metadata.create_all(db.engine, tables=[User.__table__, trigram_table])
+        yield app
+        db.session.remove()
+
+    shutil.rmtree(directory)
+
+
+@pytest.fixture
+def user_id(app):
+    user = User(email='jane@example.com', first_name='Jane', last_name='Doe', properties=PROPERTIES)
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    db.session.remove()
+    identity_cache.clear()
+    return user_id
+
+
+def _authenticate(app, user_id):
+    """Bytes fetched resolving the session cookie to the current user, and then loading the full row."""
+    cookie = _dumps({'user_id': user_id, 'real_user_id': user_id, 'real_user_tick': 0}, expires_in=3600)
+
+    with app.test_request_context('/', headers={'Cookie': 'u0={}'.format(cookie.decode())}):
+        g.user_index = 0
+        before = Fetched.size
+        identity = g.current_user
+        session_size = Fetched.size - before
+
+        before = Fetched.size
+        assert materialize(identity).id == user_id
+        return session_size, Fetched.size - before
+
+
+def test_auth_lookup_leaves_properties_out(app, user_id):
+    session_size, row_size = _authenticate(app, user_id)
+    assert 0 < session_size + row_size < len(PROPERTIES['notes'])
+
+    # the same full row with properties undeferred
+    db.session.remove()
+    before = Fetched.size
+    User.query.with_properties().get(user_id)
+    undeferred_row_size = Fetched.size - before
+
+    assert undeferred_row_size - row_size >= len(PROPERTIES['notes'])
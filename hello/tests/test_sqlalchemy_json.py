@@ -0,0 +1,109 @@
+# coding: utf-8
+
+import pytest
+
+from app.utils.sqlalchemy_json import NestedJsonObject, NestedMutable
+from app.utils.sqlalchemy_json.codec import COMPRESSED_MARKER
+from app.utils.sqlalchemy_json.track import TrackedDict, TrackedList
+
+
+def _document(cls):
+    """A tracked document whose change notifications are counted in `notifications`."""
+    document = cls({'a': {'b': {'c': []}}, 'l': [{'y': 1}]})
+    document.notifications = []
+    document.changed = lambda *args: document.notifications.append(args)
+    return document
+
+
+# every way a nested container can be read out, each handing back the dict at 'a' or in 'l'
+ACCESS_PATHS = {
+    'getitem': lambda d: d['a'],
+    'get': lambda d: d.get('a'),
+    'dict()': lambda d: dict(d)['a'],
+    'unpacking': lambda d: {**d}['a'],
+    'values()': lambda d: [x for x in d.values() if 'b' in x][0],
+    'items()': lambda d: dict(d.items())['a'],
+    'copy()': lambda d: d.copy()['a'],
+    'setdefault()': lambda d: d.setdefault('a', {}),
+    'list iteration': lambda d: [x for x in d['l']][0],
+    'list()': lambda d: list(d['l'])[0],
+    'list reversed()': lambda d: list(reversed(d['l']))[0],
+    'list slice': lambda d: d['l'][:][0],
+    'list copy()': lambda d: d['l'].copy()[0],
+    'list concatenation': lambda d: (d['l'] + [])[0],
+}
+
+
+@pytest.mark.parametrize('cls', [TrackedDict, NestedMutable])
+@pytest.mark.parametrize('path', sorted(ACCESS_PATHS))
+def test_changes_through_every_access_path_notify(cls, path):
+    document = _document(cls)
+
+    nested = ACCESS_PATHS[path](document)
+    assert isinstance(nested, TrackedDict)
+
+    nested['x'] = 1
+    assert document.notifications
+
+
+@pytest.mark.parametrize('cls', [TrackedDict, NestedMutable])
+def test_nested_containers_are_tracked_on_read(cls):
+    document = _document(cls)
+
+    assert type(dict.__getitem__(document, 'a')) is dict
+    assert isinstance(document['a']['b']['c'], TrackedList)
+
+    document['a']['b']['c'].append(1)
+    assert document.notifications
+    assert document.changed_paths == {('a', 'b', 'c')}
+
+
+@pytest.mark.parametrize('cls', [TrackedDict, NestedMutable])
+@pytest.mark.parametrize('move', [
+    lambda d: d.__setitem__('b', d.pop('a')),
+    lambda d: d.update(b=d.pop('a')),
+    lambda d: d.setdefault('b', d.pop('a')),
+])
+def test_moved_object_records_its_new_path(cls, move):
+    document = cls({'a': {'x': 1}})
+    document['a']  # tracked before the move
+    move(document)
+    document.changed_paths = None  # as after a flush
+
+    document['b']['x'] = 2
+    assert document.changed_paths == {('b', 'x')}
+    assert document == {'b': {'x': 2}}
+
+
+@pytest.mark.parametrize('cls', [TrackedDict, NestedMutable])
+def test_moved_object_between_parents(cls):
+    document = cls({'a': {'inner': {'x': 1}}, 'b': {}})
+    document['b']['inner'] = document['a'].pop('inner')
+    document.changed_paths = None
+
+    document['b']['inner']['x'] = 2
+    assert document.changed_paths == {('b', 'inner', 'x')}
+
+
+@pytest.mark.parametrize('cls', [TrackedDict, NestedMutable])
+def test_object_kept_in_two_places_is_copied(cls):
+    document = cls({'a': {'x': 1}})
+    document['b'] = document['a']
+    document.changed_paths = None
+
+    document['b']['x'] = 2
+    assert document.changed_paths == {('b', 'x')}
+    assert document == {'a': {'x': 1}, 'b': {'x': 2}}
+
+
+def test_partial_updates_need_a_native_column():
+    with pytest.raises(ValueError):
+        NestedJsonObject(partial_updates=True)
+
+    assert NestedJsonObject(partial_updates=True, native=True).partial_updates
+
+
+def test_uncompressed_documents_stay_plain_json():
+    document = {'a': 'x' * 10000}
+    assert NestedJsonObject().process_bind_param(document, None).startswith(COMPRESSED_MARKER)
+    assert NestedJsonObject(compress=False).process_bind_param(document, None).startswith('{')
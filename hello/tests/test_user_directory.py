@@ -0,0 +1,123 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import time
+
+from flask import Flask
+import pytest
+
+from app.extensions.user_directory import (PackedPrefixIndex, PackedRecords, UserDirectory,
+                                           UserDirectoryNotReadyException)
+from app.models import User
+from app.utils.database import db, trigram_table
+
+
+@pytest.fixture
+def app():
+    directory = tempfile.mkdtemp()
+
+    app = Flask('app', instance_path=directory)
+    app.config.from_object('app.settings')
+    app.config.update({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'db.sqlite'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'USER_DIRECTORY_REFRESH_INTERVAL': 0.05,
+    })
+    db.init_app(app)
+
+    with app.app_context():
+        db.metadata.create_all(db.engine, tables=[User.__table__, trigram_table])
+        db.session.add_all([
+            User(email='jane@example.com', first_name='Jane', last_name='Doe'),
+            User(email='john@example.com', first_name='John', last_name='Smith'),
+            User(email='jo@example.com', first_name=None, last_name='Jo', is_active=False),
+        ])
+        db.session.commit()
+        yield app
+        db.session.remove()
+
+    shutil.rmtree(directory)
+
+
+@pytest.fixture
+def directory(app):
+    directory = UserDirectory()
+    directory.init_app(app)
+    yield directory
+
+    thread = directory._thread
+    directory.stop()
+    if thread is not None:
+        thread.join()
+
+
+def _wait_until_ready(directory):
+    deadline = time.time() + 5
+    while not directory.ready:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def _emails(results):
+    return [x['email'] for x in results]
+
+
+def test_packed_prefix_index():
+    index = PackedPrefixIndex([(1, ['jane', 'doe']), (2, ['john', 'jöhn']), (300000, ['jane'])])
+
+    assert len(index) == 5
+    assert list(index.scan('ja')) == [(b'jane', 1), (b'jane', 300000)]
+    assert [id for _, id in index.scan('j')] == [1, 300000, 2, 2]
+    assert list(index.scan('jö')) == [('jöhn'.encode('utf-8'), 2)]
+    assert list(index.scan('x')) == []
+    assert list(PackedPrefixIndex().scan('a')) == []
+
+
+def test_packed_records():
+    records = PackedRecords({3: ('Jöhn', None, 'john@example.com'), 1: ('', 'Doe', 'jane@example.com')})
+
+    assert records.get(3) == ('Jöhn', None, 'john@example.com')
+    assert records.get(1) == ('', 'Doe', 'jane@example.com')
+    assert records.get(2) is None
+    assert records.get(4) is None
+
+
+def test_built_in_the_background(directory):
+    # the first lookup only starts the build
+    with pytest.raises(UserDirectoryNotReadyException):
+        directory.search('j')
+
+    _wait_until_ready(directory)
+    assert _emails(directory.search('j')) == ['jane@example.com', 'john@example.com']
+    assert _emails(directory.search('smi')) == ['john@example.com']
+    assert _emails(directory.search('john s')) == ['john@example.com']
+
+
+def test_changes_applied_over_the_packed_index(directory):
+    directory.warm()
+    _wait_until_ready(directory)
+
+    directory.put(1, 'Janet', 'Doe', 'janet@example.com')
+    directory.put(4, 'Jack', 'Black', 'jack@example.com')
+    directory.discard(2)
+
+    assert _emails(directory.search('j')) == ['jack@example.com', 'janet@example.com']
+    assert directory.search('jane ')[0]['first_name'] == 'Janet'
+    assert directory.search('smith') == []
+
+
+def test_changes_made_elsewhere_picked_up(directory):
+    directory.warm()
+    _wait_until_ready(directory)
+
+    user = User.query.filter_by(email='john@example.com').one()
+    user.last_name = 'Smythe'
+    db.session.commit()
+
+    deadline = time.time() + 5
+    while _emails(directory.search('smy')) != ['john@example.com']:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    assert directory.search('smi') == []